@@ -1,18 +1,21 @@
 #!/usr/bin/env python
 from abc import ABC, abstractmethod
 from functools import partial
-from numpy import array, argsort, dot, finfo, ndarray, zeros, arange, nonzero
-from typing import List, Protocol, Type
+from numpy import array, dot, finfo, ndarray, zeros, ones, arange, concatenate, cumsum, ravel_multi_index, add, int64, asarray, repeat, diff, load, savez, floor, unique
+from scipy.sparse import csr_matrix
+from typing import Dict, List, Protocol, Tuple, Type
 from tqdm import tqdm
 from loguru import logger
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, cpu_count, get_context
 from dataclasses import dataclass
-from h5py import File
-import tempfile
+from collections import defaultdict, OrderedDict
+import time
+import hashlib
 import os
 from pandas import Timestamp, Timedelta
 from pandas import DataFrame as Observations
-from transport.emis import EmissionFields, Emissions, Grid
+from transport.emis import EmissionFields, Emissions, Grid, Times
+from transport.core.shm import SharedArray, SharedFields
 
 
 class Footprint(Protocol):
@@ -31,6 +34,12 @@ class FootprintFile(Protocol):
     def align(self, grid: Grid, timestep: Timedelta, origin: Timestamp) -> int:
         ...
 
+    def footprint_sizes(self, obsids: List[str]) -> ndarray:
+        """
+        (optional) Number of non-zero elements of each footprint, used to estimate the computational cost
+        """
+        ...
+
 
 @dataclass
 class SharedMemory:
@@ -38,6 +47,10 @@ class SharedMemory:
     emis: EmissionFields = None
     obs: Observations = None
     grid: Grid = None
+    time: Times = None
+    buffer: SharedArray = None
+    slots: object = None
+    slot: int = 0
 
     def clear(self, *args):
         if len(args) == 0:
@@ -48,22 +61,303 @@ class SharedMemory:
 shared_memory = SharedMemory()
 
 
+def claim_slot(slots) -> int:
+    """
+    Take a free slot (e.g. of the adjoint buffer) for the current worker process. "slots" is a shared array with the
+    pid of the worker using each slot (0 if it is free). The slot of a worker that has died (and has been replaced by
+    the pool) is reused: the results it has already accumulated in it are kept.
+    """
+    with slots.get_lock():
+        for islot, pid in enumerate(slots):
+            if pid != 0 :
+                try :
+                    os.kill(pid, 0)
+                    continue
+                except ProcessLookupError :
+                    pass
+                except PermissionError :
+                    continue
+            slots[islot] = os.getpid()
+            return islot
+    raise RuntimeError(f"No free slot for worker process {os.getpid()}: all the {len(slots)} slots are used by running workers")
+
+
+def init_worker(footprint_class: Type[FootprintFile], state: dict) -> None:
+    """
+    Initialize the "shared_memory" of a worker process. The large arrays (emissions, adjoint buffers) are passed as
+    SharedArray/SharedFields objects, which attach to the memory of the main process instead of copying it.
+    """
+    shared_memory.footprint_class = footprint_class
+    state = dict(state)
+
+    # Settings of the footprint class (class attributes, which are not inherited by "spawn" or "forkserver" workers):
+    maxlength = state.pop('maxlength', None)
+    if maxlength is not None :
+        footprint_class.maxlength = maxlength
+
+    for k, v in state.items():
+        setattr(shared_memory, k, v)
+
+    # Each worker takes a free slot (e.g. in the adjoint buffer)
+    if shared_memory.slots is not None :
+        shared_memory.slot = claim_slot(shared_memory.slots)
+
+
+@dataclass
+class WorkUnit:
+    """
+    Elementary task of a forward or adjoint run: a set of observations in one footprint file.
+    If obsids is None, all the observations of the file are processed.
+    """
+    filename: str
+    obsids: ndarray = None
+    cost: float = 0.
+
+    def select(self, obs: Observations) -> Observations:
+        obs = obs.loc[obs.footprint == self.filename]
+        if self.obsids is not None :
+            obs = obs.loc[obs.obsid.isin(self.obsids)]
+        return obs
+
+
+def run_timed(func, unit: WorkUnit):
+    """
+    Run func(unit) and return its result, along with the worker's pid, the unit cost and the time it took
+    """
+    t0 = time.perf_counter()
+    res = func(unit)
+    return res, (os.getpid(), unit.cost, time.perf_counter() - t0)
+
+
+@dataclass
+class FootprintBatch:
+    """
+    Footprints of a set of observations, concatenated in flat (CSR-like) arrays:
+    - index: flat (time, lat, lon) index of each footprint element in the emission array
+    - sensi: sensitivity of each footprint element
+    - offsets: position of the first element of each footprint in index and sensi (nobs + 1 values)
+    """
+    offsets: ndarray
+    index: ndarray
+    sensi: ndarray
+
+    @property
+    def nobs(self) -> int:
+        return len(self.offsets) - 1
+
+    @classmethod
+    def read(cls, fpf: FootprintFile, obsids: List[str], shape: Tuple[int, int, int]) -> "FootprintBatch":
+        """
+        Read the footprints of the requested observations from an (already aligned) footprint file
+        """
+        fps = [fpf.get(obsid) for obsid in obsids]
+        offsets = zeros(len(fps) + 1, dtype=int64)
+        offsets[1:] = cumsum([len(fp.sensi) for fp in fps])
+        if offsets[-1] == 0:
+            return cls(offsets=offsets, index=zeros(0, dtype=int64), sensi=zeros(0))
+        index = ravel_multi_index((
+            concatenate([fp.itims for fp in fps]).astype(int64),
+            concatenate([fp.ilats for fp in fps]).astype(int64),
+            concatenate([fp.ilons for fp in fps]).astype(int64)
+        ), shape)
+        return cls(offsets=offsets, index=index, sensi=concatenate([fp.sensi for fp in fps]))
+
+    def apply(self, field: ndarray) -> ndarray:
+        """
+        Compute the contribution of a (nt, nlat, nlon) field to each observation of the batch.
+        """
+        res = zeros(self.nobs)
+
+        # reduceat doesn't handle empty segments, so only reduce over the non-empty footprints
+        nonempty = self.offsets[:-1] < self.offsets[1:]
+        if nonempty.any():
+            res[nonempty] = add.reduceat(field.reshape(-1)[self.index] * self.sensi, self.offsets[:-1][nonempty])
+        return res
+
+
+# Operators already loaded in this process, indexed by their hash key. Only the most recently used ones are kept (the
+# observations may change between iterations, e.g. in an inversion, and each operator can be large):
+_operators : Dict[str, "TransportOperator"] = OrderedDict()
+_max_operators = 2
+
+
+@dataclass
+class TransportOperator:
+    """
+    Observation operator (H) stored as a sparse CSR matrix:
+    - rows are the observations (in the order of the "obsids" array)
+    - columns are the flattened (time, lat, lon) indices of the emission fields
+    A forward run is then H @ x and an adjoint run H.T @ dy.
+    """
+    matrix: csr_matrix
+    obsids: ndarray
+
+    def forward(self, field: ndarray) -> ndarray:
+        return self.matrix @ field.reshape(-1)
+
+    def adjoint(self, dy: ndarray) -> ndarray:
+        return self.matrix.T @ asarray(dy, dtype=float)
+
+    @staticmethod
+    def key(obs: Observations, grid: Grid, times: Times, maxlength=None) -> str:
+        """
+        Hash key identifying an operator: it depends on the observations (and their footprint files, including their
+        size and modification time, so that the operator is rebuilt if footprints are added to them), on the emission
+        grid and time axis, and on the max footprint length.
+        """
+        sha = hashlib.sha1()
+        sha.update('\n'.join(obs.obsid.astype(str)).encode())
+        sha.update('\n'.join(obs.footprint.astype(str)).encode())
+        for filename in obs.footprint.drop_duplicates():
+            if os.path.exists(filename):
+                stat = os.stat(filename)
+                sha.update(f'{filename} {stat.st_size} {stat.st_mtime_ns}'.encode())
+        sha.update(asarray(grid.latc, dtype=float).tobytes())
+        sha.update(asarray(grid.lonc, dtype=float).tobytes())
+        sha.update(f'{times.min} {times.nt} {times.timestep} {maxlength}'.encode())
+        return sha.hexdigest()
+
+    @classmethod
+    def build(cls, footprint_class: Type[FootprintFile], obs: Observations, grid: Grid, times: Times) -> "TransportOperator":
+        """
+        Read all the footprints of the observations, and assemble them in a sparse matrix
+        """
+        shape = (times.nt, grid.nlat, grid.nlon)
+        rows, cols, values = [], [], []
+        irow = arange(obs.shape[0])
+        for filename in tqdm(obs.footprint.drop_duplicates(), desc='Build transport operator', leave=False):
+            sel = (obs.footprint == filename).values
+            with footprint_class(filename) as fpf:
+                fpf.align(grid, times.timestep, times.min)
+                fps = FootprintBatch.read(fpf, obs.obsid.values[sel], shape)
+            rows.append(repeat(irow[sel], diff(fps.offsets)))
+            cols.append(fps.index)
+            values.append(fps.sensi)
+
+        if len(rows) == 0:
+            rows, cols, values = zeros(0, dtype=int64), zeros(0, dtype=int64), zeros(0)
+        else :
+            rows, cols, values = concatenate(rows), concatenate(cols), concatenate(values)
+
+        # Duplicate elements (if any) are summed
+        matrix = csr_matrix((values, (rows, cols)), shape=(obs.shape[0], times.nt * grid.nlat * grid.nlon))
+        return cls(matrix=matrix, obsids=asarray(obs.obsid, dtype=str))
+
+    def save(self, filename: str) -> None:
+        savez(filename, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr, shape=self.matrix.shape, obsids=self.obsids)
+
+    @classmethod
+    def read(cls, filename: str) -> "TransportOperator":
+        with load(filename) as npz:
+            return cls(
+                matrix=csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape'])),
+                obsids=npz['obsids']
+            )
+
+    @classmethod
+    def get(cls, cachedir: str, footprint_class: Type[FootprintFile], obs: Observations, grid: Grid, times: Times) -> "TransportOperator":
+        """
+        Return the operator for this set of observations: from memory if it has already been used in this process,
+        from the cache directory if it has already been computed, or build it (and store it in the cache) otherwise.
+        """
+        key = cls.key(obs, grid, times, getattr(footprint_class, 'maxlength', None))
+        if key in _operators:
+            _operators.move_to_end(key)
+            return _operators[key]
+
+        filename = os.path.join(cachedir, f'operator_{key}.npz')
+        if os.path.exists(filename):
+            logger.info(f"Reading transport operator from {filename}")
+            operator = cls.read(filename)
+        else :
+            operator = cls.build(footprint_class, obs, grid, times)
+            os.makedirs(cachedir, exist_ok=True)
+            operator.save(filename)
+            logger.info(f"Transport operator ({operator.matrix.nnz} non-zero elements) stored in {filename}")
+
+        _operators[key] = operator
+        while len(_operators) > _max_operators :
+            _operators.popitem(last=False)
+        return operator
+
+
 @dataclass
 class BaseTransport:
     footprint_class: Type[FootprintFile]
     parallel: bool = False
     ncpus: int = cpu_count()
     tempdir: str='/tmp'
+    batch: bool = True
+    operator_cache: str = None
+    start_method: str = None
+    granularity: int = 4
+    report: bool = False
     _silent: bool = None
 
     def __post_init__(self):
         shared_memory.footprint_class = self.footprint_class
 
+    def pool(self, processes: int = None, **state) -> Pool:
+        """
+        Create a pool of worker processes (by default, ncpus). The data needed by the workers is passed explicitly at
+        their initialization (rather than inherited through fork), including the max footprint length set on the
+        footprint class, so any start method ("fork", "spawn", "forkserver") can be used.
+        """
+        state['maxlength'] = getattr(self.footprint_class, 'maxlength', None)
+        return get_context(self.start_method).Pool(processes=processes or self.ncpus, initializer=init_worker, initargs=(self.footprint_class, state))
+
     @property
     def silent(self):
         silent = self._silent if self._silent is not None else self.parallel
         return silent
 
+    def schedule(self, obs: Observations) -> List[WorkUnit]:
+        """
+        Split the work in units of comparable cost, with the most expensive ones first.
+        In serial runs, there's just one unit per footprint file. In parallel runs, the cost of each footprint is
+        estimated from its number of non-zero elements (if the footprint class provides that information, from the
+        number of observations otherwise), and the files are split in (file, observations) units, so that each
+        worker gets on average "granularity" units. Units are then pulled by the workers as soon as they are free.
+        """
+        obs = obs.loc[obs.footprint.notna()]
+        if not self.parallel :
+            return [WorkUnit(filename=f, cost=(obs.footprint == f).sum()) for f in obs.footprint.drop_duplicates()]
+
+        files = []
+        for filename, obslist in obs.groupby('footprint', sort=False):
+            with self.footprint_class(filename) as fpf :
+                if hasattr(fpf, 'footprint_sizes'):
+                    # Add 1 to account for the fixed cost of each observation (and for empty footprints)
+                    cost = fpf.footprint_sizes(obslist.obsid) + 1.
+                else :
+                    cost = ones(obslist.shape[0])
+            files.append((filename, obslist.obsid.values, cost))
+
+        target = sum(c.sum() for (_, _, c) in files) / (self.ncpus * self.granularity)
+        units = []
+        for filename, obsids, cost in files:
+            # Consecutive observations of a file go in the same unit, until the target cost is reached
+            iunit = floor((cumsum(cost) - cost) / target)
+            for iu in unique(iunit):
+                sel = iunit == iu
+                units.append(WorkUnit(filename=filename, obsids=obsids[sel], cost=cost[sel].sum()))
+
+        return sorted(units, key=lambda u: u.cost, reverse=True)
+
+    def report_timings(self, timings: List[tuple]) -> None:
+        """
+        Print the time spent, and the estimated cost processed, by each worker
+        """
+        workers = defaultdict(lambda: [0, 0., 0.])
+        for pid, cost, elapsed in timings :
+            workers[pid][0] += 1
+            workers[pid][1] += cost
+            workers[pid][2] += elapsed
+        busy = array([w[2] for w in workers.values()])
+        for pid, (nunits, cost, elapsed) in workers.items():
+            logger.info(f"Worker {pid}: {nunits} units, estimated cost {cost:.0f}, {elapsed:.2f} s")
+        logger.info(f"{len(timings)} units processed by {len(workers)} workers. Load imbalance (max/mean time): {busy.max()/busy.mean():.2f}")
+
     def run_files(self, *args, **kwargs) :
         if self.parallel :
             return self.run_files_mp(*args, **kwargs)
@@ -98,21 +392,25 @@ class Forward(BaseTransport):
 
     def run_tracer(self, emis: EmissionFields, obs: Observations) -> Observations:
 
-        # Retrieve the observations for that tracer, and their footprint file name:
-        filenames = obs.footprint.dropna().drop_duplicates()
+        if self.operator_cache is not None :
+            # Use the pre-computed transport operator, instead of reading the footprints
+            sel = obs.loc[obs.footprint.notna()]
+            operator = TransportOperator.get(self.operator_cache, self.footprint_class, sel, emis.grid, emis.times)
+            for field in emis.categories:
+                obs.loc[sel.index, f'mix_{field}'] = operator.forward(emis[field].data)
 
-        # To optimize CPU usage in parallell simulations, process the largest files first
-        nobs = array([obs.loc[obs.footprint == f].shape[0] for f in filenames])
-        filenames = [filenames.values[i] for i in argsort(nobs)[::-1]]
+        else :
+            # Split the observations in work units (process the largest ones first, to optimize CPU usage in parallel simulations)
+            units = self.schedule(obs)
 
-        shared_memory.emis = emis
-        shared_memory.obs = obs
+            shared_memory.emis = emis
+            shared_memory.obs = obs
 
-        for obslist in self.run_files(filenames):
-            for field in emis.categories:
-                obs.loc[obslist.index, f'mix_{field}'] = obslist.loc[:, f'mix_{field}']#.astype(float)
+            for obslist in self.run_files(units):
+                for field in emis.categories:
+                    obs.loc[obslist.index, f'mix_{field}'] = obslist.loc[:, f'mix_{field}']#.astype(float)
 
-        shared_memory.clear('emis', 'obs')
+            shared_memory.clear('emis', 'obs')
 
         # Combine the flux components :
         try:
@@ -127,31 +425,43 @@ class Forward(BaseTransport):
 
         return obs
 
-    def run_files_serial(self, filenames: List[str]) -> List[Observations]:
+    def run_files_serial(self, units: List[WorkUnit]) -> List[Observations]:
         res = []
-        for filename in tqdm(filenames):
-            res.append(self.run_file(filename, silent=self.silent))
+        for unit in tqdm(units):
+            res.append(self.run_file(unit, silent=self.silent, batch=self.batch))
         return res
 
-    def run_files_mp(self, filenames: List[str]) -> List[Observations]:
-        with Pool(processes=self.ncpus) as pool:
-            res = list(tqdm(pool.imap(self.run_file, filenames, chunksize=1), total=len(filenames), leave=False))
-        return res
+    def run_files_mp(self, units: List[WorkUnit]) -> List[Observations]:
+        func = partial(run_timed, partial(self.run_file, batch=self.batch))
+        obs = shared_memory.obs.loc[:, ['obsid', 'footprint']]
+        with SharedFields(shared_memory.emis) as emis, self.pool(emis=emis, obs=obs) as pool:
+            res = list(tqdm(pool.imap_unordered(func, units, chunksize=1), total=len(units), leave=False))
+            pool.close()
+            pool.join()
+        if self.report :
+            self.report_timings([timing for (_, timing) in res])
+        return [obslist for (obslist, _) in res]
 
     @staticmethod
-    def run_file(filename: str, silent: bool = True) -> Observations:
+    def run_file(unit: WorkUnit, silent: bool = True, batch: bool = True) -> Observations:
         """
-        Do a forward run on the selected footprint file. Set silent to False to enable progress bar
+        Do a forward run on the selected footprint file (or on a subset of its observations).
+        Set silent to False to enable progress bar.
+        In batch mode, all the footprints of the file are read at once and the mixing ratios are computed with
+        vectorized operations (no per-observation loop).
         """
 
-        obslist = shared_memory.obs
-        obslist = obslist.loc[obslist.footprint == filename, ['obsid',]]
+        obslist = unit.select(shared_memory.obs).loc[:, ['obsid',]]
         emis = shared_memory.emis
-        with shared_memory.footprint_class(filename) as fpf :
+        with shared_memory.footprint_class(unit.filename) as fpf :
 
             # Align the coordinates
             fpf.align(emis.grid, emis.times.timestep, emis.times.min)
 
+            if batch :
+                fps = FootprintBatch.read(fpf, obslist.obsid, (emis.times.nt, emis.grid.nlat, emis.grid.nlon))
+                return obslist.assign(**{f'mix_{cat}': fps.apply(emis[cat].data) for cat in emis.categories})
+
             for iobs, obs in tqdm(obslist.itertuples(), desc=fpf.filename, total=obslist.shape[0], disable=silent):
                 fp = fpf.get(obs)
                 for cat in emis.categories :
@@ -174,82 +484,87 @@ class Adjoint(BaseTransport):
 
     def run_tracer(self, adjemis: EmissionFields, obs: Observations) -> EmissionFields :
 
-        # Retrieve the observations for that tracer, and their footprint file name:
-        # Sort the files by the number of obs they contain (largest first)
-        filenames = obs.footprint.dropna().drop_duplicates()
-        nobs = array([obs.loc[obs.footprint == f].shape[0] for f in filenames])
-        filenames = [filenames.values[i] for i in argsort(nobs)[::-1]]
+        # Set the current data to 0:
+        adjemis.setzero()
+
+        if self.operator_cache is not None :
+            # Use the pre-computed transport operator, instead of reading the footprints
+            sel = obs.loc[obs.footprint.notna()]
+            operator = TransportOperator.get(self.operator_cache, self.footprint_class, sel, adjemis.grid, adjemis.times)
+            adj = operator.adjoint(sel.dy.values).reshape(adjemis.times.nt, adjemis.grid.nlat, adjemis.grid.nlon)
+            for cat in adjemis.categories :
+                adjemis[cat].data += adj
+            return adjemis
+
+        # Split the observations in work units (largest ones first):
+        units = self.schedule(obs)
 
         # Run the separate chunks
         shared_memory.obs = obs
 
-        # Set the current data to 0:
-        adjemis.setzero()
-
         # Get the shape of the adjoint field, store it in memory and create a new container for the data
         shared_memory.grid = adjemis.grid
         shared_memory.time = adjemis.times
 
-        for adjfile in tqdm(self.run_files(filenames), desc='Concatenate adjoint files', leave=False):
-            with File(adjfile, 'r') as ds :
-                coords = ds['coords'][:]
-                values = ds['values'][:]
-                for cat in adjemis.categories :
-                    adjemis[cat].data.reshape(-1)[coords] += values
-            os.remove(adjfile)
+        # Each process accumulates its part of the adjoint in its own slot of a shared memory buffer,
+        # and the slots are then summed:
+        nslots = min(self.ncpus, len(units)) if self.parallel else 1
+        with SharedArray((max(nslots, 1), adjemis.times.nt, adjemis.grid.nlat, adjemis.grid.nlon)) as buffer :
+            self.run_files(units, buffer)
+            adj = buffer.array.sum(axis=0)
+        for cat in adjemis.categories :
+            adjemis[cat].data += adj
 
         shared_memory.clear('grid', 'time', 'obs')
 
         return adjemis
 
-    def run_files_serial(self, filenames: List[str]) -> List[str]:
-        return [self.run_subset(filenames, silent=self.silent)]
+    def run_files_serial(self, units: List[WorkUnit], buffer: SharedArray) -> None:
+        for unit in tqdm(units, disable=self.silent):
+            self.run_unit(unit, buffer, silent=self.silent)
 
-    def run_files_mp(self, filenames: List[str]) -> List[str]:
+    def run_files_mp(self, units: List[WorkUnit], buffer: SharedArray) -> None:
 
-        # Distribute the files equally amongst the processes. Start with the larger files, to balance the load:
-        icpu = arange(len(filenames))
-        while icpu.max() >= self.ncpus :
-            icpu[icpu >= self.ncpus] -= self.ncpus
-        buckets = []
-        filenames = array(filenames)
-        for cpu in range(self.ncpus):
-            bucket = filenames[icpu == cpu]
-            if len(bucket) > 0 :
-                buckets.append(bucket)
+        # The units are distributed dynamically: each worker takes the next (largest) unit as soon as it is free,
+        # and accumulates the results in its own slot of the buffer.
+        # The buffer is passed to the workers at their initialization, so that they attach to it only once.
+        func = partial(run_timed, partial(self.run_unit, silent=self.silent))
+        obs = shared_memory.obs.loc[:, ['obsid', 'footprint', 'dy']]
+        slots = get_context(self.start_method).Array('i', buffer.array.shape[0])
 
-        func = partial(self.run_subset, silent=self.silent, tempdir=self.tempdir)
+        # (one worker per slot: there may be fewer slots than CPUs, if there are fewer units)
+        with self.pool(processes=buffer.array.shape[0], obs=obs, grid=shared_memory.grid, time=shared_memory.time, buffer=buffer, slots=slots) as pool :
+            res = list(tqdm(pool.imap_unordered(func, units, chunksize=1), total=len(units), desc='Compute adjoint chunks', leave=False))
+            # Let the workers exit cleanly (rather than being terminated), so they release the shared resources
+            pool.close()
+            pool.join()
 
-        with Pool(processes=self.ncpus) as pool :
-            return list(tqdm(pool.imap(func, buckets, chunksize=1), total=self.ncpus, desc='Compute adjoint chunks', leave=False))
+        if self.report :
+            self.report_timings([timing for (_, timing) in res])
 
     @staticmethod
-    def run_subset(filenames: List[str], silent: bool = True, tempdir: str = '/tmp') -> str :
-        #observations = shared_memory.obs
+    def run_unit(unit: WorkUnit, buffer: SharedArray = None, silent: bool = True) -> None :
+        """
+        Compute the adjoint for one work unit, and accumulate it in the slot of the shared buffer reserved to the
+        current process (by default, the buffer attached at the initialization of the worker)
+        """
+        if buffer is None :
+            buffer = shared_memory.buffer
         times = shared_memory.time
         grid = shared_memory.grid
+        observations = unit.select(shared_memory.obs)
 
-        adj_emis = zeros((times.nt, grid.nlat, grid.nlon))
-
-        for file in tqdm(filenames, disable=silent) :
-            observations = shared_memory.obs.loc[shared_memory.obs.footprint == file]
-
-            with shared_memory.footprint_class(file) as fpf :
-                fpf.align(grid, times.timestep, times.min)
+        adj_emis = buffer.array[shared_memory.slot]
 
-                for obs in tqdm(observations.itertuples(), desc=fpf.filename, total=observations.shape[0], disable=silent):
-                    fp = fpf.get(obs.obsid)
-                    adj_emis[fp.itims, fp.ilats, fp.ilons] += obs.dy * fp.sensi
+        with shared_memory.footprint_class(unit.filename) as fpf :
+            fpf.align(grid, times.timestep, times.min)
 
-        with tempfile.NamedTemporaryFile(dir=tempdir, prefix='adjoint_', suffix='.h5') as fid :
-            fname = fid.name
-        with File(fname, 'w') as fid :
-            adj_emis = adj_emis.reshape(-1)
-            nz = nonzero(adj_emis)[0]
-            fid['coords'] = nz
-            fid['values'] = adj_emis[nz]
+            for obs in tqdm(observations.itertuples(), desc=fpf.filename, total=observations.shape[0], disable=silent):
+                fp = fpf.get(obs.obsid)
+                adj_emis[fp.itims, fp.ilats, fp.ilons] += obs.dy * fp.sensi
 
-        return fname
+        # Release the view of the shared buffer (the memory itself is freed by the main process)
+        del adj_emis
 
 
 @dataclass
@@ -257,12 +572,16 @@ class Model(ABC):
     parallel : bool = False
     ncpus : int = cpu_count()
     tempdir : str = '/tmp'
+    batch : bool = True
+    operator_cache : str = None
+    start_method : str = None
+    report : bool = False
 
     def run_forward(self, obs: Observations, emis: Emissions) -> Observations :
-        return Forward(self.footprint_class, self.parallel, self.ncpus, tempdir=self.tempdir).run(emis, obs)
+        return Forward(self.footprint_class, self.parallel, self.ncpus, tempdir=self.tempdir, batch=self.batch, operator_cache=self.operator_cache, start_method=self.start_method, report=self.report).run(emis, obs)
 
     def run_adjoint(self, obs: Observations, adj_emis: Emissions) -> Emissions:
-        return Adjoint(self.footprint_class, self.parallel, self.ncpus, tempdir=self.tempdir).run(adj_emis, obs)
+        return Adjoint(self.footprint_class, self.parallel, self.ncpus, tempdir=self.tempdir, operator_cache=self.operator_cache, start_method=self.start_method, report=self.report).run(adj_emis, obs)
 
     @property
     @abstractmethod
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+from multiprocessing import shared_memory, resource_tracker
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+from numpy import ndarray, dtype as np_dtype, prod, float64
+from transport.emis import EmissionFields, Grid, Times
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach to an existing shared memory block, without leaving it registered with the resource tracker: only the
+    process that created the block unlinks it, and registrations by the other processes would otherwise be reported
+    as leaked (or unlinked too early) by the resource tracker.
+    """
+    try :
+        return shared_memory.SharedMemory(name=name, track=False)    # python >= 3.13
+    except TypeError :
+        pass
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class SharedArray:
+    """
+    numpy array stored in a named shared memory block (multiprocessing.shared_memory).
+    The array is created (and owned) by the main process. Other processes attach to the same memory block when
+    the object is unpickled (e.g. when it is passed as argument to a multiprocessing.Pool worker), so the data
+    itself is never copied.
+    """
+    def __init__(self, shape: Tuple[int, ...], dtype=float64, name: str = None, readonly: bool = False):
+        dtype = np_dtype(dtype)
+        self.owner = name is None
+        self.readonly = readonly
+        if self.owner :
+            nbytes = max(int(prod(shape)) * dtype.itemsize, 1)
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else :
+            self.shm = attach(name)
+        self.array = ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        if self.owner :
+            self.array[:] = 0
+        if readonly :
+            self.array.flags.writeable = False
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def __reduce__(self):
+        # Pickling only transfers the reference to the memory block, not the data
+        return self.__class__, (self.array.shape, self.array.dtype.str, self.name, self.readonly)
+
+    def close(self) -> None:
+        """
+        Detach from the memory block (and free it, in the process that created it).
+        Views of the array must have been deleted before.
+        """
+        if self.array is None :
+            return
+        self.array = None
+        self.shm.close()
+        if self.owner :
+            # (the processes attached to the block may share the resource tracker of this one, and have unregistered
+            # it there: register it again, so that the tracker doesn't complain when it is unregistered by unlink)
+            resource_tracker.register(self.shm._name, 'shared_memory')
+            self.shm.unlink()
+
+    def __enter__(self) -> "SharedArray":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+class SharedFields:
+    """
+    Read-only copy of the emission fields of one tracer, with each category stored in a SharedArray.
+    Mimics the parts of the EmissionFields interface used by the transport workers (categories, grid, times and
+    emis[cat].data), so it can be passed to worker processes without copying the data, whatever the
+    multiprocessing start method.
+    """
+    def __init__(self, emis: EmissionFields = None, arrays: Dict[str, SharedArray] = None, grid: Grid = None, times: Times = None):
+        if emis is not None :
+            arrays = {}
+            for cat in emis.categories :
+                arrays[cat] = SharedArray(emis[cat].shape, dtype=emis[cat].dtype)
+                arrays[cat].array[:] = emis[cat].data
+                arrays[cat].array.flags.writeable = False
+                arrays[cat].readonly = True
+            grid, times = emis.grid, emis.times
+        self.arrays = arrays
+        self.grid = grid
+        self.times = times
+
+    @property
+    def categories(self) -> List[str]:
+        return list(self.arrays.keys())
+
+    def __getitem__(self, cat: str) -> SimpleNamespace:
+        return SimpleNamespace(data=self.arrays[cat].array)
+
+    def __reduce__(self):
+        return self.__class__, (None, self.arrays, self.grid, self.times)
+
+    def close(self) -> None:
+        for arr in self.arrays.values():
+            arr.close()
+
+    def __enter__(self) -> "SharedFields":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import os
 import shutil
+import json
 from loguru import logger
 from transport.core import Model
 from transport.core.model import FootprintFile
@@ -10,7 +11,7 @@ from typing import List, Type
 from types import SimpleNamespace
 from pandas import Timedelta, Timestamp, DataFrame, read_hdf, isnull
 from gridtools import Grid
-from numpy import array, nan, inf
+from numpy import array, arange, nan, inf, ndarray
 from dataclasses import asdict
 from tqdm import tqdm
 
@@ -26,12 +27,24 @@ def check_migrate(source, dest):
 
 class LumiaFootprintFile(h5py.File):
     maxlength : Timedelta = inf
-    __slots__ = ['shift_t', 'origin', 'timestep', 'grid']
+    __slots__ = ['shift_t', 'origin', 'timestep', 'grid', 'layout', 'index']
 
     def __init__(self, *args, maxlength:Timedelta=inf, **kwargs):
         super().__init__(*args, mode='r', **kwargs)
         self.shift_t = 0
 
+        # Files in "indexed" layout store all the footprints in the same (concatenated) datasets, with an index
+        # table giving the position of each footprint. Older files use one group per footprint ("grouped" layout).
+        self.layout = self.attrs.get('layout', 'grouped')
+        if self.layout == 'indexed':
+            obsids = self['index/obsid'].asstr()[:]
+            sel = obsids != ''
+            self.index = DataFrame({
+                'irow': arange(len(obsids))[sel],
+                'offset': self['index/offset'][:][sel],
+                'length': self['index/length'][:][sel]
+            }, index=obsids[sel])
+
         try :
             self.origin = Timestamp(self.attrs['origin'])
             self.timestep = Timedelta(seconds=abs(self.attrs['run_loutstep']))
@@ -54,8 +67,18 @@ class LumiaFootprintFile(h5py.File):
 
     @property
     def footprints(self) -> List[str]:
+        if self.layout == 'indexed':
+            return self.index.index.tolist()
         return [k for k in self.keys() if isinstance(self[k], h5py.Group)]
 
+    def footprint_sizes(self, obsids: List[str]) -> ndarray:
+        """
+        Number of non-zero elements in each of the requested footprints (read from the metadata of the "sensi" datasets)
+        """
+        if self.layout == 'indexed':
+            return self.index.loc[obsids, 'length'].values
+        return array([self[obsid]['sensi'].shape[0] for obsid in obsids])
+
     def align(self, grid: Grid, timestep: Timedelta, origin: Timestamp):
         assert Grid(latc=grid.latc, lonc=grid.lonc) == self.grid, f"Can't align the footprint file grid ({self.grid}) to the requested grid ({Grid(**asdict(grid))})"
         assert timestep == self.timestep, "Temporal grid mismatch"
@@ -63,13 +86,41 @@ class LumiaFootprintFile(h5py.File):
         assert int(shift_t) - shift_t == 0
         self.shift_t = int(shift_t)
 
+    def read(self, obsid: str) -> SimpleNamespace:
+        """
+        Read the raw (sparse) footprint and the attributes needed to post-process it
+        """
+        if self.layout == 'indexed':
+            irow, offset, length = self.index.loc[obsid, ['irow', 'offset', 'length']]
+            sel = slice(offset, offset + length)
+            attrs = json.loads(self['index/attributes'][irow])
+            return SimpleNamespace(
+                itims=self['itims'][sel],
+                ilons=self['ilons'][sel],
+                ilats=self['ilats'][sel],
+                sensi=self['sensi'][sel],
+                runflex_version=attrs.get('runflex_version', '2000.1.1'),
+                release_end=attrs.get('release_end')
+            )
+
+        # Compatibility with the "grouped" layout
+        return SimpleNamespace(
+            itims=self[obsid]['itims'][:],
+            ilons=self[obsid]['ilons'][:],
+            ilats=self[obsid]['ilats'][:],
+            sensi=self[obsid]['sensi'][:],
+            runflex_version=self[obsid]['sensi'].attrs.get('runflex_version', '2000.1.1'),
+            release_end=self[obsid].attrs.get('release_end')
+        )
+
     def get(self, obsid) -> SimpleNamespace :
-        itims = self[obsid]['itims'][:] 
-        ilons = self[obsid]['ilons'][:]
-        ilats = self[obsid]['ilats'][:]
-        sensi = self[obsid]['sensi'][:]
+        fp = self.read(obsid)
+        itims = fp.itims
+        ilons = fp.ilons
+        ilats = fp.ilats
+        sensi = fp.sensi
 
-        if Timestamp(self[obsid]['sensi'].attrs.get('runflex_version', '2000.1.1')) > Timestamp(2022, 9, 1):
+        if Timestamp(fp.runflex_version) > Timestamp(2022, 9, 1):
             sensi *= 0.0002897
 
         # If the footprint is empty, return here:
@@ -80,7 +131,7 @@ class LumiaFootprintFile(h5py.File):
 
         # Check if the time of the last time step is same as release time (it should be lower by 1 timestep normally)
         # if it's the case, decrement that time index by 1
-        if self.origin + itims[-1] * self.timestep == Timestamp(self[obsid].attrs['release_end']):
+        if self.origin + int(itims[-1]) * self.timestep == Timestamp(fp.release_end):
             itims[-1] -= 1
 
         # Trim the footprint if needed
@@ -195,8 +246,11 @@ if __name__ == '__main__':
     p.add_argument('--adjtest', '-t', action='store_true', default=False, help="Perform and adjoint test")
     p.add_argument('--serial', '-s', action='store_true', default=False, help="Run on a single CPU")
     p.add_argument('--tmp', default='/tmp', help='Path to a temporary directory where (big) files can be written')
+    p.add_argument('--operator-cache', default=None, help="Path where the transport operator (sparse H matrix) is cached. If set, the footprints are read only once, and forward/adjoint runs are done with sparse matrix products")
     p.add_argument('--ncpus', '-n', default=os.cpu_count())
+    p.add_argument('--start-method', default=None, choices=['fork', 'spawn', 'forkserver'], help="Start method of the worker processes (default is the multiprocessing default for the platform)")
     p.add_argument('--max-footprint-length', type=Timedelta, default='14D')
+    p.add_argument('--timings', action='store_true', default=False, help="Report the time spent by each worker process (parallel runs only)")
     p.add_argument('--verbosity', '-v', default='INFO')
     p.add_argument('--obs', required=True)
     p.add_argument('--emis')#, required=True)
@@ -215,7 +269,7 @@ if __name__ == '__main__':
     if args.check_footprints or 'footprint' not in obs.columns:
         obs.check_footprints(args.footprints, LumiaFootprintFile, local=args.copy_footprints)
 
-    model = MultiTracer(parallel=not args.serial, ncpus=args.ncpus, tempdir=args.tmp)
+    model = MultiTracer(parallel=not args.serial, ncpus=args.ncpus, tempdir=args.tmp, operator_cache=args.operator_cache, start_method=args.start_method, report=args.timings)
     emis = Emissions.read(args.emis)
     if args.forward:
         obs = model.run_forward(obs, emis)
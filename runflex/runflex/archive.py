@@ -1,15 +1,18 @@
 #!/usr/bin/env python
 import sys
-from typing import List
+from typing import List, Union
 from pathlib import Path
 from loguru import logger
 from pandas import DataFrame
 import os
+import shutil
+import subprocess
 from subprocess import Popen, PIPE
 from tqdm import tqdm
 from multiprocessing import RLock
 import tempfile
 from io import FileIO
+from runflex.utilities import list_files
 
 
 lock = RLock()
@@ -99,7 +102,52 @@ class Rclone:
             # rename the temporary file, just for cleanliness
             Path(fid.name).unlink(missing_ok=True)
 
+    def copy(self, files: List[str], dest: Path, source: str = '') -> bool:
+        """
+        Non-interactive version of "retrieve" (no progress bar, and no lock, so several copies can run in parallel)
+        :param files: list of files to be retrieved
+        :param dest: destination directory
+        :param source: source directory
+        :return: True if rclone completed successfully
+        """
+        with tempfile.NamedTemporaryFile('w', delete=False) as fid:
+            fid.writelines(file + '\n' for file in files)
+        status = subprocess.run(['rclone', 'copy', os.path.join(self.address, source), '--include-from', fid.name, str(dest)], capture_output=True, text=True)
+        Path(fid.name).unlink(missing_ok=True)
+        if status.returncode != 0 :
+            logger.error(status.stderr)
+        return status.returncode == 0
+
     @staticmethod
     def check(files: List[str], dest: Path) -> bool:
-        files_missing = any(not Path(dest).joinpath(f).exists() for f in files)
-        return not files_missing
+        return set(files).issubset(list_files(dest))
+
+
+class LocalArchive:
+    def __init__(self, address: Union[str, Path], logfile : FileIO = sys.stdout):
+        """
+        Archive of meteo files in a local directory, with the same interface as Rclone (it can stand in for an rclone
+        remote, e.g. for testing). The files can be either directly in that directory, or in %Y/%-m subdirectories (as
+        in the rclone archives).
+        :param address: path of the archive directory
+        """
+        self.address = Path(address)
+        self.logfile = logfile
+
+    def get(self, files_list: DataFrame, dest: Path, attempts_nb: int = 0, info: str = None) -> bool:
+        for month, files in files_list.groupby(files_list.time.dt.strftime('%Y/%-m')):
+            self.copy(files.file.values, dest, month)
+        return self.check(list(files_list.file), dest)
+
+    def copy(self, files: List[str], dest: Path, source: str = '') -> bool:
+        Path(dest).mkdir(parents=True, exist_ok=True)
+        for file in files :
+            src = self.address / source / file
+            if not src.exists():
+                src = self.address / file
+            target = Path(dest) / file
+            if src.exists() and not (target.exists() and src.samefile(target)):
+                shutil.copy(src, target)
+        return True
+
+    check = staticmethod(Rclone.check)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+from pandas import Timedelta
+from numpy import typing, vstack, linalg, ones, array
+from pandas import DataFrame
+from omegaconf import DictConfig
+from runflex.timings import TimingDatabase
+
+
+@dataclass
+class CostModel:
+    """
+    Estimated cost (in seconds) of a FLEXPART task, as a function of the simulated period (ndays) and of the total
+    number of particles released (nparticles):
+        cost = per_day * ndays + per_particle_day * ndays * nparticles
+    The first term accounts for the costs that don't depend on the number of releases (reading and interpolating the
+    meteo), and the second for the particle transport.
+    The default coefficients are only indicative, and should be adapted to the machine (see "runflex --stats").
+    """
+    per_day: float = 10.
+    per_particle_day: float = 2.e-4
+
+    def predict(self, ndays: typing.ArrayLike, nparticles: typing.ArrayLike) -> typing.ArrayLike:
+        return self.per_day * ndays + self.per_particle_day * ndays * nparticles
+
+    def task_cost(self, times: typing.NDArray, length: Timedelta, npart: int) -> float:
+        """
+        Cost of a task, based on the release times, the length of the simulation (per release) and the number of
+        particles per release.
+        """
+        ndays = (times.max() - times.min() + length) / Timedelta(days=1)
+        return self.predict(ndays, len(times) * npart)
+
+    @classmethod
+    def fit(cls, records: DataFrame) -> "CostModel":
+        """
+        Fit the coefficients (least squares) on the timings of past tasks (see runflex.timings.TimingDatabase).
+        The cost fitted is the time spent by the task in the worker process, excluding the postprocessing (i.e. setup,
+        meteo and FLEXPART run).
+        """
+        records = records.loc[(records.status == 'success') & records.flexpart.notna()]
+        cost = (records.setup.fillna(0) + records.meteo.fillna(0) + records.flexpart).values
+        terms = vstack((records.ndays.values, (records.ndays * records.nparticles).values)).T
+        coefs = linalg.lstsq(terms, cost, rcond=None)[0]
+
+        # Coefficients can't be negative: if one is, fit the other one alone
+        if coefs[0] < 0 :
+            coefs = [0., linalg.lstsq(terms[:, 1:], cost, rcond=None)[0][0]]
+        elif coefs[1] < 0 :
+            coefs = [linalg.lstsq(terms[:, :1], cost, rcond=None)[0][0], 0.]
+        return cls(per_day=float(coefs[0]), per_particle_day=float(coefs[1]))
+
+    @staticmethod
+    def makespan(costs: List[float], ncpus: int) -> float:
+        """
+        Estimated wall time to run the tasks on ncpus processes (tasks are processed in the order given, each by the
+        first free process).
+        """
+        load = [0.] * ncpus
+        for cost in costs:
+            load[load.index(min(load))] += cost
+        return max(load)
+
+
+def outgrid_cells(rcf: DictConfig) -> int:
+    """
+    Number of cells of the FLEXPART output grid (outgrid section)
+    """
+    x0, x1, dx = rcf.outgrid.x
+    y0, y1, dy = rcf.outgrid.y
+    return int(round((x1 - x0) / dx) * round((y1 - y0) / dy) * len(rcf.outgrid.get('levels', [0])))
+
+
+@dataclass
+class MemoryModel:
+    """
+    Estimated peak memory use (in kB) of a FLEXPART task, as a function of the total number of particles released
+    (nparticles) and of the size of the output (ncells = number of releases x number of cells of the output grid,
+    since the footprints are computed separately for each release):
+        memory = base + per_particle * nparticles + per_cell * ncells
+    The default coefficients are only indicative, and are normally fitted on the timings of past tasks (see
+    MemoryModel.fit and runflex.timings.TimingDatabase).
+    """
+    base: float = 5.e5
+    per_particle: float = 0.5
+    per_cell: float = 0.02
+
+    def predict(self, nparticles: typing.ArrayLike, ncells: typing.ArrayLike) -> typing.ArrayLike:
+        return self.base + self.per_particle * nparticles + self.per_cell * ncells
+
+    def task_memory(self, nreleases: int, rcf: DictConfig) -> float:
+        """
+        Memory (in kB) of a task with nreleases releases, for the settings in rcf (releases.npart and outgrid)
+        """
+        return self.predict(nreleases * rcf.releases.npart, nreleases * outgrid_cells(rcf))
+
+    @classmethod
+    def fit(cls, records: DataFrame) -> "MemoryModel":
+        """
+        Fit the coefficients (least squares, constrained to be positive) on the peak memory use of past tasks.
+        """
+        records = records.loc[(records.status == 'success') & records.flexpart_maxrss.notna() & records.ncells.notna()]
+        memory = records.flexpart_maxrss.values.astype(float)
+        terms = vstack((ones(len(records)), records.nparticles.values, records.ncells.values)).T.astype(float)
+
+        # Remove the terms with a negative coefficient one by one, until all the coefficients are positive:
+        active = [0, 1, 2]
+        coefs = array([0., 0., 0.])
+        while active :
+            coefs[:] = 0.
+            coefs[active] = linalg.lstsq(terms[:, active], memory, rcond=None)[0]
+            if coefs.min() >= 0 :
+                break
+            active.remove(int(coefs.argmin()))
+        return cls(base=float(coefs[0]), per_particle=float(coefs[1]), per_cell=float(coefs[2]))
+
+    @classmethod
+    def from_timings(cls, filename: str, minrecords: int = 5) -> "MemoryModel":
+        """
+        Model fitted on the timings database, if it has enough records (at least "minrecords" completed tasks).
+        The default model is returned otherwise.
+        """
+        if filename and Path(filename).exists():
+            records = TimingDatabase(filename).records
+            if ((records.status == 'success') & records.flexpart_maxrss.notna() & records.ncells.notna()).sum() >= minrecords :
+                return cls.fit(records)
+        return cls()
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import shutil
+import pickle
+import tempfile
+import subprocess
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Union
+from concurrent.futures import as_completed, wait, ProcessPoolExecutor, FIRST_COMPLETED
+from multiprocessing import cpu_count
+from loguru import logger
+from omegaconf import DictConfig
+from runflex.tasks import Task, JobInfo
+from runflex.journal import update_journal
+from runflex.costs import MemoryModel
+import runflex.config    # registers the omegaconf resolvers, needed to read the configuration in the worker processes
+
+
+def failed(job: JobInfo, exception: BaseException) -> JobInfo:
+    """
+    Mark a job that raised an exception in its worker as failed
+    """
+    logger.opt(exception=exception).error(f"Task {job.jobid} failed")
+    job.status = 'failed'
+    update_journal(job, 'failed')
+    return job
+
+
+class Executor:
+    """
+    Base class for the execution backends of the QueueManager.
+    The "map" method runs the tasks, and yields them as they complete (in any order). Tasks that could not be run
+    (e.g. a worker that crashed) are returned as their JobInfo, with the "failed" status.
+    """
+
+    def map(self, jobs: List[JobInfo]) -> Iterator[Union[Task, JobInfo]]:
+        raise NotImplementedError
+
+    @property
+    def concurrency(self) -> Union[int, None]:
+        """
+        Maximum number of tasks running simultaneously (None if it isn't bounded or known)
+        """
+        return None
+
+
+class SerialExecutor(Executor):
+    """
+    Run the tasks one after the other, in the current process (interactive mode).
+    """
+    concurrency = 1
+
+    def map(self, jobs: List[JobInfo]) -> Iterator[Task]:
+        for job in jobs :
+            yield Task.run_from_JobInfo(job, interactive=True)
+
+
+@dataclass
+class PoolExecutor(Executor):
+    """
+    Run the tasks in a pool of ncpus processes (on the current node).
+    If a memory budget (in MB) is given, the tasks are only started as long as the sum of their estimated peak memory
+    use (see runflex.costs.MemoryModel) fits in it. The tasks are started in the order of the list (which is also the
+    order in which their meteo is prefetched, see runflex.prefetch): when the next task doesn't fit, it waits for
+    running tasks to complete (if no task is running, it is started anyway). ncpus is then the maximum number of tasks
+    running simultaneously, which can exceed the number of CPUs (e.g. for I/O-bound tasks).
+    """
+    ncpus: int = None
+    memory: float = None
+    model: MemoryModel = field(default_factory=MemoryModel)
+
+    @property
+    def concurrency(self) -> int:
+        return self.ncpus or cpu_count()
+
+    def map(self, jobs: List[JobInfo]) -> Iterator[Union[Task, JobInfo]]:
+        if self.memory is None :
+            with ProcessPoolExecutor(max_workers=self.ncpus) as pool :
+                futures = {pool.submit(Task.run_from_JobInfo, job): job for job in jobs}
+                for future in as_completed(futures):
+                    if future.exception() is None :
+                        yield future.result()
+                    else :
+                        yield failed(futures[future], future.exception())
+            return
+
+        ncpus = self.ncpus or cpu_count()
+        required = [self.model.task_memory(len(job.releases), job.rcf) / 1024 for job in jobs]
+        queued = list(range(len(jobs)))
+        running = {}
+        with ProcessPoolExecutor(max_workers=ncpus) as pool :
+            while queued or running :
+                # Start the next tasks, as long as they fit in the memory left:
+                available = self.memory - sum(required[i] for i in running.values())
+                while queued and len(running) < ncpus :
+                    ijob = queued[0]
+                    if required[ijob] > available :
+                        if running :
+                            break
+                        logger.warning(f"Task {jobs[ijob].jobid} is estimated to need {required[ijob]:.0f} MB (memory budget: {self.memory:.0f} MB)")
+                    running[pool.submit(Task.run_from_JobInfo, jobs[ijob])] = ijob
+                    queued.pop(0)
+                    available -= required[ijob]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done :
+                    job = jobs[running.pop(future)]
+                    if future.exception() is None :
+                        yield future.result()
+                    else :
+                        yield failed(job, future.exception())
+
+
+@dataclass
+class MPIExecutor(Executor):
+    """
+    Run the tasks on the MPI processes of an mpi4py.futures.MPIPoolExecutor (e.g. with runflex started as
+    "mpiexec -n N python -m mpi4py.futures $(which runflex) ...", or spawning ncpus workers, if the MPI implementation
+    supports it).
+    """
+    ncpus: int = None
+
+    @property
+    def concurrency(self) -> Union[int, None]:
+        return self.ncpus
+
+    def map(self, jobs: List[JobInfo]) -> Iterator[Union[Task, JobInfo]]:
+        from mpi4py.futures import MPIPoolExecutor
+
+        with MPIPoolExecutor(max_workers=self.ncpus) as pool :
+            futures = {pool.submit(Task.run_from_JobInfo, job): job for job in jobs}
+            for future in as_completed(futures):
+                if future.exception() is None :
+                    yield future.result()
+                else :
+                    yield failed(futures[future], future.exception())
+
+
+@dataclass
+class JobFilesExecutor(Executor):
+    """
+    Base class for the backends running the tasks in independent processes (possibly on other nodes): the JobInfo
+    objects are pickled to a (shared) job directory, each worker process runs one of them ("python -m
+    runflex.executors jobdir index"), and pickles the resulting Task back in the same directory. The results are
+    collected as they appear, and jobs whose process ended without a result are reported as failed.
+    Each call to "map" uses its own sub-directory of the job directory (workdir), so that several runflex instances can
+    share it. The sub-directory is removed at the end, unless some tasks failed (it then contains their logs).
+    Subclasses implement the "start" and "ended" methods, to start the worker processes and check which ones have
+    ended.
+    """
+    jobdir: Union[str, Path]
+    poll: float = 30.    # Interval (in seconds) between two checks for the completed tasks
+
+    def __post_init__(self):
+        self.jobdir = Path(self.jobdir)
+        self.workdir = None
+
+    def jobfile(self, index: int) -> Path:
+        return self.workdir / f'{index}.job.pkl'
+
+    def resultfile(self, index: int) -> Path:
+        return self.workdir / f'{index}.result.pkl'
+
+    def start(self, njobs: int) -> None:
+        raise NotImplementedError
+
+    def ended(self) -> List[int]:
+        """
+        Indices of the jobs whose worker process has ended
+        """
+        raise NotImplementedError
+
+    def map(self, jobs: List[JobInfo]) -> Iterator[Union[Task, JobInfo]]:
+        if not jobs :
+            return
+        self.jobdir.mkdir(parents=True, exist_ok=True)
+        self.workdir = Path(tempfile.mkdtemp(dir=self.jobdir, prefix='run.'))
+        for index, job in enumerate(jobs):
+            with open(self.jobfile(index), 'wb') as fid :
+                pickle.dump(job, fid)
+
+        self.start(len(jobs))
+
+        pending = dict(enumerate(jobs))
+        suspect = set()
+        nfailed = 0
+        while pending :
+            # Check for the ended jobs before the results, so that a result written just after the check isn't missed:
+            ended = set(self.ended())
+            for index in list(pending):
+                if self.resultfile(index).exists():
+                    with open(self.resultfile(index), 'rb') as fid :
+                        result = pickle.load(fid)
+                    nfailed += result.status == 'failed'
+                    del pending[index]
+                    yield result
+                elif index in ended :
+                    # The result may take some time to be visible on a shared file system, so wait until the next
+                    # check before declaring the job failed:
+                    if index in suspect :
+                        logger.error(f"Task {pending[index].jobid} ended without result (see the log files in {self.workdir})")
+                        nfailed += 1
+                        pending[index].status = 'failed'
+                        update_journal(pending[index], 'failed')
+                        yield pending.pop(index)
+                    suspect.add(index)
+            if pending :
+                time.sleep(self.poll)
+
+        if nfailed :
+            logger.warning(f"{nfailed:.0f} tasks failed, their job files and logs are kept in {self.workdir}")
+        else :
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+@dataclass
+class ProcessExecutor(JobFilesExecutor):
+    """
+    Run each task in a separate python process (at most ncpus at a time), on the current node. This is meant as a
+    stand-in for the SLURM backend, for testing (it goes through the same serialization of the jobs and results).
+    """
+    ncpus: int = field(default_factory=cpu_count)
+    poll: float = 1.
+
+    @property
+    def concurrency(self) -> int:
+        return self.ncpus or cpu_count()
+
+    def start(self, njobs: int) -> None:
+        self.queued = list(range(njobs))
+        self.processes: Dict[int, subprocess.Popen] = {}
+        self.ended()
+
+    def ended(self) -> List[int]:
+        ended = [index for (index, process) in self.processes.items() if process.poll() is not None]
+        while self.queued and len(self.processes) - len(ended) < self.ncpus :
+            index = self.queued.pop(0)
+            with open(self.workdir / f'{index}.out', 'w') as fid :
+                self.processes[index] = subprocess.Popen([sys.executable, '-m', 'runflex.executors', str(self.workdir), str(index)], stdout=fid, stderr=subprocess.STDOUT)
+        return ended
+
+
+@dataclass
+class SlurmExecutor(JobFilesExecutor):
+    """
+    Run the tasks as the elements of a SLURM job array (one task per array element), so that they can be spread over
+    several nodes. The job directory (and the run directory) must be on a file system shared by the nodes.
+    - "options" are passed as #SBATCH directives (e.g. {'partition': 'thin', 'time': '02:00:00', 'mem-per-cpu': '4G'});
+    - "maxrunning" limits the number of array elements running simultaneously;
+    - "command" is the command used to start python in the array elements (e.g. "singularity exec runflex.sif python").
+    """
+    options: dict = field(default_factory=dict)
+    maxrunning: int = None
+    command: str = sys.executable
+
+    @property
+    def concurrency(self) -> Union[int, None]:
+        return self.maxrunning
+
+    def start(self, njobs: int) -> None:
+        array = f'0-{njobs - 1}' + (f'%{self.maxrunning}' if self.maxrunning else '')
+        script = ['#!/bin/bash', '#SBATCH --job-name=runflex', f'#SBATCH --array={array}', '#SBATCH --ntasks=1']
+        script.append(f'#SBATCH --output={self.workdir}/%a.out')
+        script.extend(f'#SBATCH --{k}={v}' for (k, v) in self.options.items())
+        script.append(f'{self.command} -m runflex.executors {self.workdir} $SLURM_ARRAY_TASK_ID')
+        with open(self.workdir / 'array.sh', 'w') as fid :
+            fid.write('\n'.join(script) + '\n')
+        self.jobid = subprocess.run(['sbatch', '--parsable', self.workdir / 'array.sh'], capture_output=True, text=True, check=True).stdout.strip().split(';')[0]
+        logger.info(f"Submitted {njobs:.0f} tasks as SLURM job array {self.jobid}")
+
+    def ended(self) -> List[int]:
+        states = subprocess.run(['sacct', '-j', self.jobid, '-X', '-n', '-P', '--format=JobID,State'], capture_output=True, text=True).stdout
+        ended = []
+        for line in states.splitlines():
+            jobid, state = line.split('|')
+            index = jobid.split('_')[-1]
+            if index.isdigit() and state.split()[0] not in ['PENDING', 'RUNNING', 'REQUEUED', 'RESIZING', 'SUSPENDED']:
+                ended.append(int(index))
+        return ended
+
+
+def cgroup_memory_limit() -> Union[float, None]:
+    """
+    Memory limit (in MB) of the cgroup of the current process (cgroup v2 or v1), or None if there is none.
+    """
+    for path in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'] :
+        try :
+            with open(path) as fid :
+                limit = fid.read().strip()
+        except OSError :
+            continue
+        # (cgroup v1 reports "no limit" as a very large number)
+        if limit != 'max' and int(limit) < 2 ** 60 :
+            return int(limit) / 1024 ** 2
+    return None
+
+
+def memory_budget(rcf: DictConfig) -> Union[float, None]:
+    """
+    Memory (in MB) available for the tasks on the node, set by run.memory: either a value, or "auto" to use the memory
+    allocated to the SLURM job (--mem or --mem-per-cpu), or otherwise the memory available on the node (within the
+    cgroup limit, if there is one). The run.memory_headroom setting (in MB) is kept aside, e.g. for the postprocessing,
+    which runs in the same processes as FLEXPART but isn't accounted for in the memory model. Returns None (no limit)
+    if run.memory is not set.
+    """
+    memory = rcf.run.get('memory', None)
+    if memory is None :
+        return None
+    if memory == 'auto' :
+        if 'SLURM_MEM_PER_NODE' in os.environ :
+            memory = float(os.environ['SLURM_MEM_PER_NODE'])
+        elif 'SLURM_MEM_PER_CPU' in os.environ and 'SLURM_CPUS_ON_NODE' in os.environ :
+            memory = float(os.environ['SLURM_MEM_PER_CPU']) * int(os.environ['SLURM_CPUS_ON_NODE'])
+        else :
+            with open('/proc/meminfo') as fid :
+                meminfo = dict(line.split(':') for line in fid)
+            memory = float(meminfo['MemAvailable'].split()[0]) / 1024
+            limit = cgroup_memory_limit()
+            if limit is not None :
+                memory = min(memory, limit)
+    return memory - rcf.run.get('memory_headroom', 0)
+
+
+def memory_model(rcf: DictConfig) -> MemoryModel:
+    """
+    Model of the memory use of the tasks: given by run.memory_model, or fitted on the past tasks (run.timings).
+    """
+    if 'memory_model' in rcf.run :
+        return MemoryModel(**rcf.run.memory_model)
+    return MemoryModel.from_timings(rcf.run.get('timings', None))
+
+
+def get_executor(rcf: DictConfig, serial: bool = False, ncpus: int = None) -> Executor:
+    """
+    Execution backend selected by the "run.executor" key (local, process, slurm or mpi).
+    """
+    if serial :
+        return SerialExecutor()
+    jobdir = rcf.run.get('jobdir', os.path.join(rcf.paths.run, 'jobs'))
+    match rcf.run.get('executor', 'local'):
+        case 'local':
+            return PoolExecutor(ncpus=rcf.run.get('maxworkers', ncpus), memory=memory_budget(rcf), model=memory_model(rcf))
+        case 'process':
+            return ProcessExecutor(jobdir=jobdir, ncpus=ncpus)
+        case 'slurm':
+            return SlurmExecutor(jobdir=jobdir, **rcf.run.get('slurm', {}))
+        case 'mpi':
+            return MPIExecutor(ncpus=ncpus)
+        case executor :
+            logger.critical(f"Unknown executor: {executor}")
+            raise NotImplementedError
+
+
+def run_job(jobdir: Union[str, Path], index: int) -> None:
+    """
+    Run one of the tasks pickled in jobdir, and pickle the result (worker side of the JobFilesExecutor backends).
+    """
+    jobdir = Path(jobdir)
+    with open(jobdir / f'{index}.job.pkl', 'rb') as fid :
+        job = pickle.load(fid)
+    try :
+        result = Task.run_from_JobInfo(job)
+    except Exception :
+        logger.exception(f"Task {job.jobid} failed")
+        job.status = 'failed'
+        update_journal(job, 'failed')
+        result = job
+
+    # Write to a temporary file first, so that the main process never reads an incomplete file
+    with open(jobdir / f'{index}.result.pkl.tmp', 'wb') as fid :
+        pickle.dump(result, fid)
+    os.replace(jobdir / f'{index}.result.pkl.tmp', jobdir / f'{index}.result.pkl')
+
+
+if __name__ == '__main__':
+    run_job(sys.argv[1], int(sys.argv[2]))
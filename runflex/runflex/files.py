@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from dataclasses import dataclass
-from typing import List
+from typing import Dict, List
 from loguru import logger
 from pandas import Timestamp
 from typing import Union
@@ -45,21 +45,26 @@ class Namelist:
         :return:
         """
         with open(filename, mode) as fid:
-            fid.write(f'&{name}\n')
-            for key in self.fields:
-                if isinstance(self[key], str):
-                    # Wrap strings in quotes
-                    value = f'"{self[key]}"'
-                elif hasattr(self[key], '__iter__'):
-                    # if value is an iterable, then write it as a comma-separated list
-                    value = ", ".join([str(_) for _ in self[key]])
-                else:
-                    # otherwise, just write the key
-                    value = self[key]
-                fid.write(f' {prefix}{key} = {value}\n')
-            fid.write(' /\n\n')
+            fid.write(self.format(name, prefix))
         return filename
 
+    def format(self, name: str = None, prefix: str = '') -> str:
+        """
+        Text of the namelist (see Namelist.write)
+        """
+        values = []
+        for key in self.fields:
+            if isinstance(self[key], str):
+                # Wrap strings in quotes
+                values.append(f'"{self[key]}"')
+            elif hasattr(self[key], '__iter__'):
+                # if value is an iterable, then write it as a comma-separated list
+                values.append(", ".join([str(_) for _ in self[key]]))
+            else:
+                # otherwise, just write the key
+                values.append(f'{self[key]}')
+        return format_namelists(name, dict(zip(self.fields, [[v] for v in values])), prefix=prefix)
+
     def __setitem__(self, key: str, value):
         if key.upper() in self.fields:
             self.__setattr__(key.upper(), value)
@@ -96,6 +101,17 @@ class Namelist:
         return data
 
 
+def format_namelists(name: str, fields: Dict[str, List[str]], prefix: str = '') -> str:
+    """
+    Text of a series of namelists with the same keys (e.g. the RELEASE namelists of a RELEASES file), built in one go.
+    :param name: name of the namelists
+    :param fields: for each key, the (already formatted) values it takes in the successive namelists
+    :param prefix: prefix common to all keys
+    """
+    template = f'&{name}\n' + ''.join(f' {prefix}{key} = {{}}\n' for key in fields) + ' /\n\n'
+    return ''.join(template.format(*values) for values in zip(*fields.values()))
+
+
 class FloatList(list):
     def __init__(self, arg):
         super().__init__([float(_) for _ in arg])
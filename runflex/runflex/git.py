@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
+import os
 import runflex
 import git
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+from typing import Union
+from loguru import logger
 
 # # Fix for the "ValueError: SHA could not be resolved, git returned: b''" error
 # # https://github.com/gitpython-developers/GitPython/issues/1016
@@ -36,4 +42,51 @@ import git
 #
 # #commit = repo.head.object
 
-commit = git.Repo(runflex.prefix).head.object
\ No newline at end of file
+
+@dataclass
+class Provenance:
+    """
+    Version of the runflex code used to compute the footprints (stored in the footprint files).
+    """
+    version: str
+    commit: str = 'unknown'
+    dirty: bool = False
+
+    @classmethod
+    def from_repo(cls, path: Path) -> "Provenance":
+        repo = git.Repo(path, search_parent_directories=True)
+        commit = repo.head.object
+        return cls(
+            version=commit.committed_datetime.strftime('%Y.%-m.%-d'),
+            commit=f'{commit.hexsha} ({commit.committed_datetime})',
+            dirty=repo.is_dirty()
+        )
+
+    @classmethod
+    def from_environment(cls) -> Union["Provenance", None]:
+        """
+        Read the provenance from the RUNFLEX_VERSION (YYYY.M.D date of the commit), RUNFLEX_COMMIT and RUNFLEX_DIRTY
+        environment variables (e.g. in containers, where the .git folder is missing).
+        """
+        if 'RUNFLEX_VERSION' not in os.environ:
+            return None
+        return cls(
+            version=os.environ['RUNFLEX_VERSION'],
+            commit=os.environ.get('RUNFLEX_COMMIT', cls.commit),
+            dirty=os.environ.get('RUNFLEX_DIRTY', 'false').lower() in ['1', 'true', 'yes']
+        )
+
+
+@cache
+def get_provenance() -> Provenance:
+    """
+    Determine the provenance once per process: from the environment if it has been set there, or from the git repository.
+    """
+    provenance = Provenance.from_environment()
+    if provenance is None :
+        try :
+            provenance = Provenance.from_repo(runflex.prefix)
+        except (git.InvalidGitRepositoryError, git.NoSuchPathError, ValueError) as e:
+            logger.error(f"Could not determine the runflex version from the git repository in {runflex.prefix}. Set the RUNFLEX_VERSION and RUNFLEX_COMMIT environment variables to provide it.")
+            raise e
+    return provenance
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Type, Union
+from loguru import logger
+from pandas import DataFrame, read_sql
+from tqdm import tqdm
+from runflex.utilities import connect
+
+
+def file_state(filename: Union[str, Path]) -> tuple:
+    """
+    Modification time (in ns, since float times may be rounded differently on network file systems) and size of a file
+    """
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Inventory:
+    """
+    Index of the footprints present in the LUMIA footprint files of an output directory, stored in a SQLite database
+    (footprints.db) in that directory:
+    - the "footprints" table lists the footprints (obsid) in each file, with their size (number of non-zero elements)
+      and the time at which they were written;
+    - the "files" table stores the modification time and size of each file when its content was last recorded.
+    The inventory is updated by the postprocessing (LumiaFile), and files that have been modified by other means
+    (e.g. files created before the inventory) are re-scanned when their modification time or size doesn't match.
+    File names are relative to the output directory.
+    """
+    dbname = 'footprints.db'
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with connect(self.path / self.dbname) as db :
+            db.execute('CREATE TABLE IF NOT EXISTS footprints (filename TEXT, obsid TEXT, size INTEGER, written REAL, PRIMARY KEY (filename, obsid))')
+            # (the files table of older inventories only had the modification time: these files are re-scanned)
+            if 'mtime_ns' not in [row[1] for row in db.execute('PRAGMA table_info(files)')]:
+                db.execute('DROP TABLE IF EXISTS files')
+            db.execute('CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER)')
+
+    def is_current(self, filename: Union[str, Path]) -> bool:
+        """
+        Check if the content of a file is up to date in the inventory (i.e. it hasn't been modified since)
+        """
+        filename = Path(filename)
+        with connect(self.path / self.dbname) as db :
+            row = db.execute('SELECT mtime_ns, size FROM files WHERE filename = ?', (filename.name,)).fetchone()
+        if not filename.exists():
+            return row is None
+        return row is not None and tuple(row) == file_state(filename)
+
+    def add(self, filename: Union[str, Path], footprints: Dict[str, int], current: bool = True) -> None:
+        """
+        Register footprints (obsid: size) written to a file. If the inventory was up to date for that file before the
+        footprints were written ("current" argument), it is still up to date after.
+        """
+        filename = Path(filename)
+        now = time.time()
+        with connect(self.path / self.dbname) as db :
+            db.executemany('INSERT OR REPLACE INTO footprints VALUES (?, ?, ?, ?)', [(filename.name, obsid, int(size), now) for (obsid, size) in footprints.items()])
+            if current :
+                db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (filename.name, *file_state(filename)))
+
+    def refresh(self, filenames: List[Union[str, Path]], footprint: Type) -> None:
+        """
+        Scan the files that have been modified since they were last recorded in the inventory.
+        """
+        with connect(self.path / self.dbname) as db :
+            states = {filename: (mtime, size) for (filename, mtime, size) in db.execute('SELECT filename, mtime_ns, size FROM files').fetchall()}
+
+        for filename in tqdm(filenames, desc=f'Updating the footprints inventory in {self.path}', leave=False):
+            filename = Path(filename)
+            if not filename.exists():
+                logger.warning(f"File {filename} not found.")
+                if filename.name in states :
+                    with connect(self.path / self.dbname) as db :
+                        db.execute('DELETE FROM footprints WHERE filename = ?', (filename.name,))
+                        db.execute('DELETE FROM files WHERE filename = ?', (filename.name,))
+                continue
+
+            state = file_state(filename)
+            if states.get(filename.name) == state :
+                continue
+
+            with footprint(str(filename), 'r') as fp :
+                obsids = fp.footprints
+            now = time.time()
+            with connect(self.path / self.dbname) as db :
+                db.execute('DELETE FROM footprints WHERE filename = ?', (filename.name,))
+                db.executemany('INSERT INTO footprints VALUES (?, ?, NULL, ?)', [(filename.name, obsid, now) for obsid in obsids])
+                db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (filename.name, *state))
+
+    @property
+    def footprints(self) -> DataFrame:
+        with connect(self.path / self.dbname) as db :
+            return read_sql('SELECT filename, obsid, size, written FROM footprints', db)
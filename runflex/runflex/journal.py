@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import time
+import json
+import hashlib
+from pathlib import Path
+from typing import List, Tuple, Union
+from omegaconf import DictConfig, OmegaConf
+from pandas import DataFrame, read_sql
+from numpy import arange, zeros
+from runflex.utilities import connect
+
+
+def task_key(releases: DataFrame, rcf: DictConfig) -> str:
+    """
+    Content hash identifying a task: it depends on the releases of the task (the columns used in the RELEASES file,
+    irrespective of their order), and on the settings that affect the FLEXPART simulation (releases, outgrid and
+    command sections, FLEXPART build, COMMAND file and meteo path).
+    """
+    settings = {k: OmegaConf.to_container(rcf[k], resolve=True) for k in ['releases', 'outgrid', 'command'] if k in rcf}
+    settings['paths'] = {k: str(rcf.paths[k]) for k in ['build', 'command', 'meteo'] if k in rcf.paths}
+    columns = [c for c in ['obsid', 'time', 'lat', 'lon', 'release_height', 'kindz'] if c in releases]
+    content = json.dumps(settings, sort_keys=True) + releases.loc[:, columns].sort_values(columns).to_csv(index=False)
+    return hashlib.sha1(content.encode()).hexdigest()[:16]
+
+
+def final_state(rcf: DictConfig) -> str:
+    """
+    State of the completed tasks: "postprocessed" if the footprints are extracted by runflex, "flexpart_done" otherwise.
+    """
+    return 'postprocessed' if rcf.postprocess.get('lumia', False) else 'flexpart_done'
+
+
+class Journal:
+    """
+    Journal of the tasks of a (possibly interrupted and restarted) footprint campaign, stored in a SQLite database.
+    The tasks are identified by their content hash (see task_key), and their state is updated as they progress:
+    queued, running, flexpart_done, postprocessed or failed. The observations of each task are also stored, so that
+    the footprints of the completed tasks can be skipped without checking the output files, and the unfinished tasks
+    re-created identically (and in the same run directory) when the run is restarted.
+    """
+    states = ['queued', 'running', 'flexpart_done', 'postprocessed', 'failed']
+
+    def __init__(self, filename: Union[str, Path]):
+        self.filename = Path(filename)
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        with connect(self.filename) as db :
+            db.execute('CREATE TABLE IF NOT EXISTS tasks (key TEXT PRIMARY KEY, state TEXT, jobid INTEGER, rundir TEXT, updated REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS releases (key TEXT, obsid TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS releases_key ON releases (key)')
+
+    def queue(self, jobs: List) -> None:
+        """
+        Register tasks (JobInfo) about to be submitted. Tasks already in the journal are set back to "queued", unless
+        FLEXPART has completed for them.
+        """
+        now = time.time()
+        with connect(self.filename) as db :
+            for job in jobs :
+                db.execute(
+                    "INSERT INTO tasks VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                    "state = CASE WHEN state = 'flexpart_done' THEN state ELSE excluded.state END, "
+                    "jobid = excluded.jobid, rundir = excluded.rundir, updated = excluded.updated",
+                    (job.key, 'queued', job.jobid, str(job.rundir), now)
+                )
+                db.execute('DELETE FROM releases WHERE key = ?', (job.key,))
+                db.executemany('INSERT INTO releases VALUES (?, ?)', [(job.key, obsid) for obsid in job.releases.obsid])
+
+    def update(self, key: str, state: str) -> None:
+        assert state in self.states, f"Invalid task state: {state}"
+        with connect(self.filename) as db :
+            db.execute('UPDATE tasks SET state = ?, updated = ? WHERE key = ?', (state, time.time(), key))
+
+    def count(self, state: str, since: float = 0.) -> int:
+        """
+        Number of tasks in a given state, updated since the "since" time (in seconds since the epoch)
+        """
+        with connect(self.filename) as db :
+            return db.execute('SELECT COUNT(*) FROM tasks WHERE state = ? AND updated >= ?', (state, since)).fetchone()[0]
+
+    def obsids(self, states: List[str]) -> DataFrame:
+        """
+        Observations (obsid) of the tasks (key) in the requested states.
+        """
+        with connect(self.filename) as db :
+            return read_sql(f'SELECT tasks.key, obsid FROM tasks JOIN releases ON tasks.key = releases.key WHERE state IN ({", ".join("?" * len(states))})', db, params=states)
+
+    def resume(self, obs: DataFrame, rcf: DictConfig, final: str = 'postprocessed') -> Tuple[List[DataFrame], DataFrame]:
+        """
+        Re-create the unfinished tasks (i.e. not in the "final" state) of the journal, whose observations are all in obs
+        (and whose content hasn't changed). Returns these tasks, and the remaining observations (to be split in new tasks).
+        """
+        pending = self.obsids([s for s in self.states if s != final])
+        ntasks = pending.groupby('key').size()
+        found = DataFrame({'obsid': obs.obsid.values, 'ipos': arange(len(obs))}).merge(pending, on='obsid')
+
+        tasks = []
+        reused = zeros(len(obs), dtype=bool)
+        for key, task in found.groupby('key'):
+            if len(task) == ntasks[key] and not reused[task.ipos].any():
+                releases = obs.iloc[task.ipos.values].sort_values('time')
+                if task_key(releases, rcf) == key :
+                    tasks.append(releases)
+                    reused[task.ipos] = True
+        return tasks, obs.iloc[~reused]
+
+
+def update_journal(job, state: str) -> None:
+    """
+    Update the state of a task (Task or JobInfo) in the journal (run.journal), if there is one.
+    """
+    if job.key is not None and job.rcf.run.get('journal', None):
+        Journal(job.rcf.run.journal).update(job.key, state)
@@ -1,12 +1,20 @@
 #!/usr/bin/env python
 import time
 
+from loguru import logger
 from pandas import DataFrame, Timedelta
-from typing import List
-from multiprocessing import Pool, cpu_count
+from typing import List, Iterator, Union
+from multiprocessing import Process, Queue, cpu_count
 import os
-from runflex.tasks import Task, JobInfo
-from runflex.observations import Observations
+from runflex.tasks import Task, JobInfo, prepare_template
+from runflex.executors import get_executor
+from runflex.observations import Observations, merge_tasks
+from runflex.costs import CostModel
+from runflex.releases import Releases
+from runflex.journal import Journal, task_key, final_state
+from runflex.postprocess import postprocess_queue
+from runflex.prefetch import MeteoPrefetcher
+from runflex.telemetry import Telemetry
 from omegaconf import DictConfig
 from tqdm import tqdm
 
@@ -18,6 +26,8 @@ class QueueManager:
         # self.rcfile = os.path.join(self.rcf.paths.global_scratch, 'flexpart.rc')
         self.serial = serial
         self.ncpus = self.rcf.run.get('ncpus', cpu_count())
+        self.executor = get_executor(self.rcf, serial=serial, ncpus=self.ncpus)
+        self.telemetry = None
 
     def dispatch(self, nobsmax: int = None, maxdt: Timedelta = '7D', skiptasks: List[int] = None, chunks : List[int] = None) -> List[Task]:
         tasks = self.create_tasks(nobsmax=nobsmax, maxdt=maxdt, skiptasks=skiptasks, chunks=chunks)
@@ -27,15 +37,53 @@ class QueueManager:
         if nobsmax is None :
             nobsmax = self.rcf.run.get('releases_per_task', 50)
 
-        dbfiles = self.obs.split(nobsmax=nobsmax, ncpus=self.ncpus, maxdt=maxdt)
+        obs = self.obs
+        if 'obsid' not in obs :
+            obs.loc[:, 'obsid'] = obs.gen_obsid()
 
+        # Re-create first the unfinished tasks of the journal (if any), so that an interrupted run resumes where it stopped:
+        dbfiles = []
+        journal = None
+        if self.rcf.run.get('journal', None):
+            journal = Journal(self.rcf.run.journal)
+            dbfiles, obs = journal.resume(obs, self.rcf, final=final_state(self.rcf))
+            dbfiles = [Releases(rl) for rl in dbfiles]
+            if dbfiles :
+                logger.info(f"Resuming {len(dbfiles):.0f} unfinished tasks from {self.rcf.run.journal}")
+
+        if not obs.empty :
+            split = obs.split(
+                nobsmax=nobsmax, ncpus=self.ncpus, maxdt=maxdt,
+                packing=self.rcf.run.get('packing', 'time'),
+                cost=CostModel(**self.rcf.run.get('cost_model', {})),
+                length=Timedelta(days=self.rcf.releases.length),
+                npart=self.rcf.releases.npart
+            )
+
+            # Optionally, merge the tasks that share most of their meteo in single FLEXPART runs:
+            if self.rcf.run.get('merge', False):
+                if not isinstance(self.rcf.run.merge, DictConfig):
+                    logger.critical(f"run.merge must be a mapping of merge_tasks options (e.g. {{overlap: 0.75, maxreleases: 200}}), not {self.rcf.run.merge!r}")
+                    raise TypeError("run.merge must be a mapping")
+                split = merge_tasks(
+                    split, **{'mintasks': self.ncpus, **self.rcf.run.merge},
+                    length=Timedelta(days=self.rcf.releases.length),
+                    npart=self.rcf.releases.npart,
+                    tres=Timedelta(self.rcf.meteo.interv)
+                )
+            dbfiles.extend(split)
+
+        # The run directories are named after the content of the tasks (rather than their number), so that they don't
+        # change if the observations are split differently
         tasks = []
         for jobnum, rl in enumerate(dbfiles):
+            key = task_key(rl, self.rcf)
             tasks.append(JobInfo(
-                rundir=os.path.join(self.rcf.paths['run'], str(jobnum)),
+                rundir=os.path.join(self.rcf.paths['run'], key),
                 rcf=self.rcf,
                 releases=rl,
                 jobid=jobnum,
+                key=key,
             ))
 
         if chunks :
@@ -44,17 +92,81 @@ class QueueManager:
         if skiptasks:
             tasks = [j for j in tasks if j.jobid not in skiptasks]
 
+        # The files common to all the tasks are prepared once, in a template run directory. This is only done if
+        # FLEXPART has to run for some of the tasks (i.e. not for the tasks resumed with a flexpart.ok file):
+        torun = [j for j in tasks if not os.path.exists(os.path.join(j.rundir, 'flexpart.ok'))]
+        if torun :
+            template = prepare_template(self.rcf)
+            for job in torun :
+                job.template = template
+
+        if journal is not None :
+            journal.queue(tasks)
+
         return tasks
 
     def submit(self, tasks: List[JobInfo]) -> List[Task]:
         """
-        Submit the individual FLEXPART runs
+        Submit the individual FLEXPART runs, using the execution backend selected by run.executor (see
+        runflex.executors). Tasks that could not be run are returned as JobInfo, with the "failed" status.
         """
-        if self.serial :
-            tasks = [Task.run_from_JobInfo(j, interactive=True) for j in tasks]
-        else :
-            with Pool(processes=self.ncpus) as pp:
-                results = pp.imap(Task.run_from_JobInfo, tasks, chunksize=1)
-                tasks = [t for t in tqdm(results, total=len(tasks), )]
+        # Progress and throughput of the tasks (see runflex.telemetry):
+        self.telemetry = Telemetry.from_config(self.rcf, tasks, self.ncpus)
+        if self.telemetry is not None :
+            self.telemetry.start()
 
-        return tasks
+        try :
+            if not self.serial and self.rcf.postprocess.get('lumia', False) and self.rcf.postprocess.get('writer', False):
+                return self.submit_with_writer(tasks)
+
+            results = [t for t in self.collect(tasks)]
+            return sorted(results, key=lambda t: t.jobid)
+        finally :
+            if self.telemetry is not None :
+                self.telemetry.stop()
+
+    def collect(self, tasks: List[JobInfo]) -> Iterator[Union[Task, JobInfo]]:
+        """
+        Run the tasks with the executor, and yield them as they complete. The meteo files of the next tasks are
+        retrieved in the background in the meantime (see runflex.prefetch.MeteoPrefetcher).
+        """
+        prefetcher = MeteoPrefetcher.from_config(self.rcf, tasks, offset=self.executor.concurrency)
+        if prefetcher is not None :
+            for job in prefetcher.jobs :
+                job.prefetched = True
+            prefetcher.start()
+        try :
+            for task in tqdm(self.executor.map(tasks), total=len(tasks), disable=self.serial):
+                if prefetcher is not None :
+                    prefetcher.done(task)
+                if self.telemetry is not None :
+                    self.telemetry.task_done(task)
+                yield task
+        finally :
+            if prefetcher is not None :
+                prefetcher.stop()
+
+    def submit_with_writer(self, tasks: List[JobInfo]) -> List[Task]:
+        """
+        Submit the FLEXPART runs, and hand each completed task to a dedicated writer process, which does the
+        postprocessing, while the workers go on with the next FLEXPART runs.
+        """
+        for job in tasks :
+            job.postprocess = False
+
+        queue = Queue()
+        writer = Process(target=postprocess_queue, args=(queue,))
+        writer.start()
+
+        results = []
+        for task in self.collect(tasks):
+            # (jobs that could not be run at all are returned as JobInfo, and have nothing to postprocess)
+            if isinstance(task, Task):
+                queue.put(task)
+            results.append(task)
+
+        # Wait for the writer to complete
+        queue.put(None)
+        writer.join()
+
+        return sorted(results, key=lambda t: t.jobid)
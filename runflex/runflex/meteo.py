@@ -1,16 +1,22 @@
 #!/usr/bin/env python
 import sys
 
-from pandas import Timedelta, Timestamp, date_range, DataFrame
+from pandas import Timedelta, Timestamp, date_range, DataFrame, Series, Index, to_datetime, concat
 from dataclasses import dataclass
 from datetime import datetime
 from loguru import logger
 import os
+import time
+import socket
 from pathlib import Path
-import glob
+from typing import List, Set, Union
 from numpy import array, argsort
-from runflex.archive import Rclone
+from omegaconf import DictConfig
+from runflex.archive import Rclone, LocalArchive
+from runflex.utilities import connect, list_files, touch
 import io
+import shutil
+import tempfile
 
 
 @dataclass(kw_only=True)
@@ -24,6 +30,9 @@ class Meteo:
 
     def __post_init__(self):
         self.path = Path(self.path)
+        # A path can be given instead of an rclone remote
+        if isinstance(self.archive, (str, Path)):
+            self.archive = LocalArchive(self.archive)
 
     def __setattr__(self, key, value):
         if key in ['tres', 'path']:
@@ -39,16 +48,42 @@ class Meteo:
         # Generate the list of files
         files = self.gen_filelist(start, end)
 
-        # Attempt to clone files from archive:
-        info = None if self.task_id is None else f'task {self.task_id}'
-        self.archive.logfile = self.logfile
-        success = self.archive.get(files, self.path, info=info)
+        # Attempt to clone files from archive (or just check that they are there, if there's no archive):
+        tstart = time.time()
+        if self.archive is None :
+            success = Rclone.check(files.file, self.path)
+        else :
+            info = None if self.task_id is None else f'task {self.task_id}'
+            self.archive.logfile = self.logfile
+            success = self.archive.get(files, self.path, info=info)
+        tcheck = time.time()
 
         # touch all the files so that they don't get removed:
-        _ = [Path(f).touch() for f in str(self.path) + '/' + files.file if Path(f).exists()]
+        present = list_files(self.path)
+        touch([self.path / f for f in files.file if f in present])
+        logger.info(f"{len(files):.0f} meteo files checked/retrieved in {tcheck - tstart:.2f} s, touched in {time.time() - tcheck:.2f} s")
 
         return success
 
+    def fetch(self, files: DataFrame) -> None:
+        """
+        Retrieve files from the archive (e.g. in advance of the tasks that need them, see runflex.prefetch). The files
+        are first retrieved in a staging directory, and then moved to the meteo directory, so that they never appear
+        there incomplete.
+        :param files: DataFrame with "time" and "file" columns (as returned by gen_filelist)
+        """
+        files = files.loc[~files.file.isin(list_files(self.path))]
+        if files.empty :
+            return
+        staging = Path(tempfile.mkdtemp(dir=self.path, prefix='.staging.'))
+        try :
+            for month, files_month in files.groupby(files.time.dt.strftime('%Y/%-m')):
+                self.archive.copy(list(files_month.file), staging, month)
+            for file in staging.iterdir():
+                file.rename(self.path / file.name)
+        finally :
+            shutil.rmtree(staging, ignore_errors=True)
+
     def gen_filelist(self, start: Timestamp, end: Timestamp) -> DataFrame:
         """
         Generate a list of meteo files that FLEXPART will need.
@@ -56,20 +91,28 @@ class Meteo:
         times = date_range(start - self.tres, end + self.tres, freq=self.tres)
         return DataFrame.from_dict({'time': times, 'file': [f'{self.prefix}{tt:%y%m%d%H}' for tt in times]})
 
-    def write_AVAILABLE(self, filepath: str) -> None:
-        fmt = f'{self.prefix}????????'
-        flist = glob.glob(os.path.join(self.path, fmt))
-        times = [datetime.strptime(os.path.basename(f), f'{self.prefix}%y%m%d%H') for f in flist]
+    def write_AVAILABLE(self, filepath: str, start: Timestamp = None, end: Timestamp = None) -> None:
+        """
+        Write the AVAILABLE file, listing the meteo files present in the meteo directory. If start and end are
+        provided, only the files in the [start - tres, end + tres] interval are listed (i.e. the files needed for a
+        simulation between start and end).
+        """
+        times = MeteoIndex.get(self.path, self.prefix).times
+        if start is not None :
+            times = times[times >= start - self.tres]
+        if end is not None :
+            times = times[times <= end + self.tres]
         with open(filepath, 'w') as fid :
             fid.writelines(['\n']*3)
-            for tt in sorted(times) :
+            for tt in times :
                 fid.write(tt.strftime(f'%Y%m%d %H%M%S      {self.prefix}%y%m%d%H         ON DISC\n'))
 
-    def cleanup(self, threshold: Timedelta = Timedelta(0), nfilesmin : int = None):
+    def cleanup(self, threshold: Timedelta = Timedelta(0), nfilesmin : int = None, leased: Set[str] = None):
         """
         Remove old meteo files. The one with the oldest last access time will be removed in priority
         :param threshold: Age threshold below which the files won't be removed
         :param nfilesmin: Minimum number of files to keep.
+        :param leased: Files in use (or about to be used) by other tasks, which must not be removed.
         """
 
         # At least one of the two options need to be set
@@ -81,11 +124,113 @@ class Meteo:
         atime = array([datetime.fromtimestamp(_.stat().st_atime) for _ in files])
         age = datetime.now() - atime
 
-        # if a min number of files is requested, remove them from the pool of
-        # "deletable" files.
-        if nfilesmin and nfilesmin > len(files):
+        # if a min number of files is requested, remove them (the most recently used ones) from the pool of
+        # "deletable" files. (This used to be done only if there were less than nfilesmin files, i.e. when there was
+        # nothing to remove anyway, so that the most recently used files were never protected.)
+        if nfilesmin :
             files = files[argsort(age)][nfilesmin:]
             age = age[argsort(age)][nfilesmin:]
 
+        # Files with a lease can't be removed
+        if leased :
+            keep = array([f.name in leased for f in files], dtype=bool)
+            files, age = files[~keep], age[~keep]
+
         # Remove the remaining files
         _ = [f.unlink() for f in files[age > threshold]]
+
+
+class MeteoIndex:
+    """
+    Index of the meteo files of a directory (time of each file), kept in memory and updated only when the directory
+    has been modified (i.e. when its modification time has changed). Only the names of the files that have been
+    added since the previous update are parsed.
+    Use MeteoIndex.get to reuse the index of a directory (one instance per directory and prefix, in each process).
+    """
+    instances = {}
+
+    def __init__(self, path: Union[str, Path], prefix: str):
+        self.path = Path(path)
+        self.prefix = prefix
+        self.mtime = None
+        self.files = Series(dtype='datetime64[ns]')
+
+    @classmethod
+    def get(cls, path: Union[str, Path], prefix: str) -> "MeteoIndex":
+        key = (str(path), prefix)
+        if key not in cls.instances :
+            cls.instances[key] = cls(path, prefix)
+        return cls.instances[key]
+
+    def update(self) -> None:
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime :
+            return
+
+        names = [e.name for e in os.scandir(self.path) if len(e.name) == len(self.prefix) + 8 and e.name.startswith(self.prefix)]
+        new = Index(names).difference(self.files.index)
+        times = to_datetime(new.str[len(self.prefix):], format='%y%m%d%H', errors='coerce')
+        self.files = concat([self.files.loc[self.files.index.isin(names)], Series(times, index=new).dropna()]).sort_values()
+
+        # Files added during the same clock tick as the last modification would be missed by the next update, so the
+        # modification time is only recorded if it's old enough:
+        if time.time_ns() - mtime > 2e9 :
+            self.mtime = mtime
+
+    @property
+    def times(self) -> Series:
+        """
+        Times of the meteo files (sorted), indexed by file name
+        """
+        self.update()
+        return self.files
+
+
+class MeteoLeases:
+    """
+    Leases (reference counts) on the files of a meteo directory, stored in a SQLite database shared by all the
+    processes using that directory: a task holds a lease on each of the meteo files it needs, from before they are
+    downloaded until the end of its FLEXPART run, and the cleanup of the meteo directory only removes files without
+    lease. Leases are identified by their holder (e.g. a task run directory), and record the host and process that
+    took them, so that the leases of processes that died without releasing them can be ignored (on the same host).
+    """
+    def __init__(self, filename: Union[str, Path]):
+        self.filename = Path(filename)
+        with connect(self.filename) as db :
+            db.execute('CREATE TABLE IF NOT EXISTS leases (file TEXT, holder TEXT, host TEXT, pid INTEGER, acquired REAL, PRIMARY KEY (file, holder))')
+
+    def acquire(self, holder: str, files: List[str]) -> None:
+        host, pid, now = socket.gethostname(), os.getpid(), time.time()
+        with connect(self.filename) as db :
+            db.executemany('INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?, ?)', [(f, holder, host, pid, now) for f in files])
+
+    def release(self, *holders: str) -> None:
+        with connect(self.filename) as db :
+            db.executemany('DELETE FROM leases WHERE holder = ?', [(holder,) for holder in holders])
+
+    @property
+    def leased(self) -> Set[str]:
+        """
+        Files with at least one live lease
+        """
+        host = socket.gethostname()
+        with connect(self.filename) as db :
+            # Remove the leases of the processes that don't exist anymore on this host:
+            for (pid,) in db.execute('SELECT DISTINCT pid FROM leases WHERE host = ?', (host,)).fetchall():
+                try :
+                    os.kill(pid, 0)
+                except ProcessLookupError :
+                    logger.warning(f"Removing the meteo leases of process {pid}, which has ended without releasing them")
+                    db.execute('DELETE FROM leases WHERE host = ? AND pid = ?', (host, pid))
+                except PermissionError :
+                    pass
+            return {f for (f,) in db.execute('SELECT DISTINCT file FROM leases').fetchall()}
+
+
+def get_leases(rcf: DictConfig) -> Union[MeteoLeases, None]:
+    """
+    Leases database of the meteo directory (meteo.leases setting, leases.db in the meteo directory by default), if
+    runflex manages its content (i.e. if files are retrieved from an archive, or cleaned up).
+    """
+    if rcf.meteo.get('archive', None) or rcf.meteo.get('cleanup', False):
+        return MeteoLeases(rcf.meteo.get('leases', Path(rcf.paths.meteo) / 'leases.db'))
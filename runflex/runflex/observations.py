@@ -2,11 +2,14 @@
 from pandas import DataFrame, read_csv, read_hdf, Timedelta, date_range, concat
 import tarfile
 from loguru import logger
-from typing import List, Protocol, Union, Type
+from typing import List, Protocol, Union, Type, Tuple
 from tqdm import tqdm
-from numpy import unique, array, ceil, typing
+from numpy import unique, array, ceil, typing, zeros, arange, geomspace, inf
 import os
 from runflex.releases import Releases
+from runflex.inventory import Inventory
+from runflex.utilities import checkpath
+from runflex.costs import CostModel
 
 
 class FootprintClass(Protocol):
@@ -171,18 +174,15 @@ class Observations(DataFrame):
         if 'obsid' not in self:
             self.loc[:, 'obsid'] = self.gen_obsid()
 
-        # Check in each file:
-        self.loc[:, 'present'] = False
-        for filename in tqdm(unique(filenames), desc=f'Checking the presence of footprints in {path}'):
-            dfs = self.loc[filenames == filename]
-            try:
-                with footprint(filename, 'r') as fp:
-                    self.loc[filenames == filename, 'present'] = [o in fp.footprints for o in dfs.obsid]
-            except FileNotFoundError:
-                logger.warning(f"File {filename} not found.")
+        # Update the inventory of the footprints (only the files modified since the last check need to be opened),
+        # and search the observations in it:
+        inventory = Inventory(checkpath(path))
+        inventory.refresh(unique(filenames), footprint)
+        footprints = inventory.footprints.loc[:, ['filename', 'obsid']]
+        requested = DataFrame({'filename': [os.path.basename(f) for f in filenames], 'obsid': self.obsid.values})
+        present = requested.merge(footprints.drop_duplicates(), how='left', indicator=True)._merge == 'both'
 
-        missing = (~self.present).tolist()
-        self.drop(columns='present')
+        missing = (~present).tolist()
 
         # Message summary of footprints presence:
         if self.loc[missing, :].empty:
@@ -201,7 +201,15 @@ class Observations(DataFrame):
         obsid = self.code + '.' + self.height.astype(int).astype(str) + 'm.' + self.time.dt.strftime('%Y%m%d-%H%M%S')
         return obsid.values
 
-    def split(self, nobsmax: int = None, ncpus: int = 1, maxdt: Union[str, Timedelta] = '7D') -> List[Releases]:
+    def split(self, nobsmax: int = None, ncpus: int = 1, maxdt: Union[str, Timedelta] = '7D', packing: str = 'time', cost: CostModel = None, length: Timedelta = Timedelta(days=14), npart: int = 1) -> List[Releases]:
+        """
+        Split the observations in tasks:
+        - with packing = 'time' (default), consecutive observations are grouped in tasks of nobsmax observations (at most
+          maxdt apart);
+        - with packing = 'cost', the tasks are determined so as to minimize their total estimated cost (see Observations.pack).
+        """
+        if packing == 'cost':
+            return self.pack(nobsmax=nobsmax, ncpus=ncpus, maxdt=maxdt, cost=cost, length=length, npart=npart)
 
         # Sort the observations by time (so that consecutive obs end up in the same tasks).
         self.sort_values('time', inplace=True)
@@ -234,3 +242,116 @@ class Observations(DataFrame):
         logger.info(f"            Number of tasks : {len(releases):.0f}")
 
         return releases
+
+    def pack(self, nobsmax: int = None, ncpus: int = 1, maxdt: Union[str, Timedelta] = '7D', cost: CostModel = None, length: Timedelta = Timedelta(days=14), npart: int = 1) -> List[Releases]:
+        """
+        Group the observations in tasks so as to minimize the estimated cost of the FLEXPART simulations (with the
+        cost of a task depending on its simulated period, i.e. the time span of its releases + the simulation length,
+        and on its number of particles, see runflex.costs.CostModel).
+        The observations are sorted by time, and split in consecutive groups of at most nobsmax observations (at
+        most maxdt apart), using dynamic programming to find the split with the lowest total cost. To balance the load
+        between the CPUs, the split is computed for several limits on the cost of individual tasks, and the one with
+        the shortest predicted wall time on ncpus processes is retained.
+        The tasks are returned by order of decreasing cost (so that the longest ones are started first).
+        """
+        cost = CostModel() if cost is None else cost
+        maxdt = Timedelta(maxdt)
+
+        # Naive split (for comparison):
+        naive = [cost.task_cost(rl.time, length, npart) for rl in self.split(nobsmax=nobsmax, ncpus=ncpus, maxdt=maxdt)]
+
+        self.sort_values('time', inplace=True)
+        times = ((self.time - self.time.min()) / Timedelta(days=1)).values
+        ndays = length / Timedelta(days=1)
+        nobs = len(times)
+
+        def task_cost(i0: int, i1: int) -> float:
+            return cost.predict(times[i1 - 1] - times[i0] + ndays, (i1 - i0) * npart)
+
+        def optimal_split(maxcost: float) -> List[Tuple[int, int]]:
+            # best[i] is the minimum cost for the first i observations, and start[i] the position of the first
+            # observation of the last task in that optimal split:
+            best = zeros(nobs + 1)
+            start = zeros(nobs + 1, dtype=int)
+            for iobs in range(nobs):
+                first = arange(max(0, iobs + 1 - nobsmax), iobs + 1)
+                costs = cost.predict(times[iobs] - times[first] + ndays, (iobs + 1 - first) * npart)
+                # (tasks of a single observation are always allowed)
+                valid = ((times[iobs] - times[first] <= maxdt / Timedelta(days=1)) & (costs <= maxcost)) | (first == iobs)
+                first, costs = first[valid], best[first[valid]] + costs[valid]
+                best[iobs + 1] = costs.min()
+                start[iobs + 1] = first[costs.argmin()]
+
+            bounds = [nobs]
+            while bounds[0] > 0:
+                bounds.insert(0, start[bounds[0]])
+            return sorted(zip(bounds[:-1], bounds[1:]), key=lambda t: -task_cost(*t))
+
+        # Try a range of maximum costs per task, between the cost of a single release and no limit:
+        tasks = optimal_split(inf)
+        mincost = cost.predict(ndays, npart)
+        for maxcost in geomspace(mincost, task_cost(*tasks[0]), 20)[:-1]:
+            split = optimal_split(maxcost)
+            if cost.makespan([task_cost(*t) for t in split], ncpus) < cost.makespan([task_cost(*t) for t in tasks], ncpus):
+                tasks = split
+
+        releases = [Releases(self.iloc[i0: i1]) for (i0, i1) in tasks]
+        packed = [cost.task_cost(rl.time, length, npart) for rl in releases]
+
+        logger.info(f"            Number of tasks : {len(releases):.0f} (naive split: {len(naive):.0f})")
+        logger.info(f"     Predicted total cost : {sum(packed):.0f} s (naive split: {sum(naive):.0f} s)")
+        logger.info(f"  Predicted wall time ({ncpus:.0f} CPUs) : {cost.makespan(packed, ncpus):.0f} s (naive split: {cost.makespan(naive, ncpus):.0f} s)")
+
+        return releases
+
+
+def merge_tasks(tasks: List[Releases], overlap: float = 0.75, maxreleases: int = None, maxparticles: int = None, mintasks: int = 1, length: Timedelta = Timedelta(days=14), npart: int = 1, tres: Timedelta = Timedelta(hours=1)) -> List[Releases]:
+    """
+    Merge tasks whose simulated periods overlap strongly in single FLEXPART runs (with more releases), so that the
+    meteo fields they share are only read once:
+    - the simulated period of a task is taken as [first release - length, last release];
+    - the tasks are considered by order of start of their simulated period, and each one is merged with the previous
+      (merged) task if at least a fraction "overlap" of its simulated period is already covered by it;
+    - the merged tasks can't have more than "maxreleases" releases, or "maxparticles" particles (the memory used by
+      FLEXPART is mostly determined by the number of particles). If neither is set, "maxreleases" defaults to four
+      times the size of the largest task;
+    - the tasks are not merged further once there would be less than "mintasks" tasks left (e.g. the number of CPUs).
+    The merged tasks are returned in the order of the first of their tasks in the input list. The number of meteo
+    fields (one every "tres") read before and after the merge is reported.
+    """
+    def period(rl: Releases) -> Tuple[Timedelta, Timedelta]:
+        return rl.time.min() - length, rl.time.max()
+
+    def nfields(rl: Releases) -> int:
+        start, end = period(rl)
+        return int((end - start) / tres) + 1
+
+    if maxreleases is None and maxparticles is None :
+        maxreleases = 4 * max(len(rl) for rl in tasks)
+
+    order = sorted(range(len(tasks)), key=lambda i: period(tasks[i])[0])
+    groups = []
+    merges = 0
+    for itask in order :
+        start, end = period(tasks[itask])
+        # (each merge removes one task from the final list)
+        if groups and len(tasks) - merges > mintasks :
+            group = groups[-1]
+            nrel = sum(len(tasks[i]) for i in group['tasks']) + len(tasks[itask])
+            covered = min(end, group['end']) - max(start, group['start'])
+            if (covered >= overlap * (end - start)
+                    and (maxreleases is None or nrel <= maxreleases)
+                    and (maxparticles is None or nrel * npart <= maxparticles)):
+                group['tasks'].append(itask)
+                group['end'] = max(group['end'], end)
+                merges += 1
+                continue
+        groups.append({'tasks': [itask], 'start': start, 'end': end})
+
+    merged = [Releases(concat([tasks[i] for i in group['tasks']]).sort_values('time')) for group in sorted(groups, key=lambda g: min(g['tasks']))]
+
+    before = sum(nfields(rl) for rl in tasks)
+    after = sum(nfields(rl) for rl in merged)
+    logger.info(f"     Merged tasks : {len(tasks):.0f} -> {len(merged):.0f}")
+    logger.info(f"     Meteo fields read : {after:.0f} (before merging: {before:.0f}, {1 - after / max(before, 1):.0%} less)")
+    return merged
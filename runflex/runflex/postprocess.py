@@ -1,18 +1,33 @@
 #!/usr/bin/env python
 from netCDF4 import Dataset, chartostring, Group
-from h5py import File
+from h5py import File, string_dtype
 from pandas import DataFrame, Timestamp, Timedelta, TimedeltaIndex
 import time
 import os
+import json
+import re
 from loguru import logger
 from dataclasses import dataclass, field
 from numpy.typing import NDArray
-from typing import Union
+from typing import Union, List, Iterator
+from multiprocessing import Queue
 from types import SimpleNamespace
-from numpy import nonzero, meshgrid, array, int16, array_equal
-import runflex
+from pathlib import Path
+from numpy import nonzero, flatnonzero, unravel_index, array, int16, int64, array_equal, searchsorted
 from runflex.utilities import checkpath
-from git import Repo
+from runflex.git import get_provenance
+from runflex.inventory import Inventory
+from runflex.journal import update_journal
+
+
+def sparse_footprint(sensi: NDArray, iflat: NDArray, shape: tuple) -> SimpleNamespace:
+    """
+    Sparse footprint from its non-zero values and their flat indices in a (time, lat, lon) array of the given shape.
+    The coordinate indices are computed with unravel_index (rather than by indexing full-size coordinate grids), and
+    stored as int16 (as in the LUMIA files), so the memory needed scales with the number of non-zero elements.
+    """
+    itime, ilat, ilon = unravel_index(iflat, shape)
+    return SimpleNamespace(sensi=sensi, ilat=ilat.astype(int16), ilon=ilon.astype(int16), itime=itime.astype(int16))
 
 
 @dataclass
@@ -22,27 +37,36 @@ class Release:
     dt: Timedelta
     release_attributes: dict = field(default_factory=dict)
     run_attributes: dict = field(default_factory=dict)
-    coordinates: SimpleNamespace = SimpleNamespace(lon=None, lat=None, time=None)
-    grid: SimpleNamespace = SimpleNamespace(lon=None, lat=None, time=None)
+    coordinates: SimpleNamespace = field(default_factory=lambda: SimpleNamespace(lon=None, lat=None, time=None))
+    grid: SimpleNamespace = field(default_factory=lambda: SimpleNamespace(shape=None, height=None))
     specie: dict = field(default_factory=dict)
     nshift: int = 0
+    sparse: SimpleNamespace = None
 
     @property
     def footprint(self) -> SimpleNamespace:
-        data = self.data.reshape(-1)
-        sel = nonzero(data)
+        # The sparse footprint is either pre-computed (see GridTimeFile.iter_releases), or computed from the dense data
+        sparse = self.sparse
+        if sparse is None :
+            data = self.data.reshape(-1)
+            sel = flatnonzero(data)
+            sparse = sparse_footprint(data[sel], sel, self.data.shape)
         return SimpleNamespace(
-            sensi=data[sel],
-            ilat=self.grid.lat[sel],
-            ilon=self.grid.lon[sel],
-            itime=self.grid.time[sel] + self.nshift
+            sensi=sparse.sensi,
+            ilat=sparse.ilat,
+            ilon=sparse.ilon,
+            itime=sparse.itime + self.nshift
         )
 
     def __post_init__(self):
         # Convert self.data in m2.s/mol:
         if self.specie['units'] == 's.m3/kg':
-            self.data /= self.grid.height
-            self.data *= 1000 * self.specie['weightmolar']
+            if self.sparse is None :
+                self.data /= self.grid.height
+                self.data *= 1000 * self.specie['weightmolar']
+            else :
+                self.sparse.sensi /= self.grid.height
+                self.sparse.sensi *= 1000 * self.specie['weightmolar']
             self.specie['units'] = 's.m2/mol'
 
     def shift_origin(self, new_origin: Timestamp):
@@ -57,8 +81,29 @@ class Release:
         self.origin = new_origin
 
 
+def encode_attributes(attrs: dict) -> str:
+    """
+    JSON-encoded footprint attributes (numpy scalars are converted to python types, and other objects to strings)
+    """
+    return json.dumps(attrs, default=lambda v: v.item() if hasattr(v, 'item') else str(v))
+
+
 class LumiaFile(File):
-    def __init__(self, *args, origin: Timestamp, count: int = 0, wait: int = 1, **kwargs):
+    """
+    LUMIA footprint file. Two layouts are supported:
+    - "grouped" (default for new files): one HDF5 group per footprint, as expected by the LUMIA readers.
+    - "indexed" (postprocess.layout: indexed): the footprints are concatenated in four root-level datasets (ilons,
+      ilats, itims and sensi), and an "index" group gives, for each footprint, its obsid, offset, length and attributes.
+    The layout of an existing file is preserved when new footprints are added to it.
+    """
+    def __init__(self, *args, origin: Timestamp, layout: str = 'grouped', inventory: Inventory = None, count: int = 0, wait: int = 1, **kwargs):
+        # Footprints written to the file (obsid: size), registered in the inventory, if any, when the file is closed.
+        # Check before opening the file if the inventory was up-to-date for it.
+        self.path = Path(args[0])
+        self.inventory = inventory
+        self.current = inventory.is_current(self.path) if inventory is not None else False
+        self.written = {}
+
         # Open the file, but wait for it to be free if it's busy
         maxcount = 20
         try:
@@ -69,7 +114,8 @@ class LumiaFile(File):
                 time.sleep(wait)
                 count += 1
                 wait += count
-                self.__init__(*args, origin=origin, count=count, wait=wait, **kwargs)
+                self.__init__(*args, origin=origin, layout=layout, inventory=inventory, count=count, wait=wait, **kwargs)
+                return
             else:
                 logger.error(f"Couldn't open file {args[0]} (File busy?)")
                 raise e
@@ -78,6 +124,20 @@ class LumiaFile(File):
         self.origin = origin
         self.attrs['origin'] = str(self.origin)
 
+        # Layout of the file (files created before the indexed layout was introduced don't have the attribute)
+        if 'layout' in self.attrs:
+            layout = self.attrs['layout']
+        elif 'latitudes' in self:
+            layout = 'grouped'
+        assert layout in ['indexed', 'grouped'], f"Unknown LUMIA file layout: {layout}"
+        self.layout = layout
+        self.attrs['layout'] = layout
+
+        # Position of the footprints in the index (indexed layout only)
+        self.index = {}
+        if 'index' in self:
+            self.index = {obsid: irow for (irow, obsid) in enumerate(self['index/obsid'].asstr()[:]) if obsid}
+
     def add(self, release: Release, background: Union[None, Group]) -> None:
         # Make sure that all data is on the same time coordinates
         # (only for non empty footprints)
@@ -107,43 +167,176 @@ class LumiaFile(File):
         for k, v in release.specie.items():
             self.attrs[f'species_{k}'] = v
 
-        # Write the release:
-        # If a release with the same name is present, delete it
-        obsid = release.release_attributes['name']
-        if obsid in self:
-            del self[obsid]
-
-        # Store the release:
-        gr = self.create_group(obsid)
-        gr['ilons'] = release.footprint.ilon.astype(int16)
-        gr['ilats'] = release.footprint.ilat.astype(int16)
-        gr['itims'] = release.footprint.itime.astype(int16)
-        gr['sensi'] = release.footprint.sensi
-        gr['sensi'].attrs['units'] = release.specie['units']
-        commit = Repo(runflex.prefix).head.object
-        gr['sensi'].attrs['runflex_version'] = commit.committed_datetime.strftime('%Y.%-m.%-d')
-        gr['sensi'].attrs['runflex_commit'] = f'{commit.hexsha} ({commit.committed_datetime})'
+        # Footprint attributes
+        provenance = get_provenance()
+        attrs = {
+            'units': release.specie['units'],
+            'runflex_version': provenance.version,
+            'runflex_commit': provenance.commit,
+            'runflex_dirty': provenance.dirty
+        }
         for k, v in release.release_attributes.items():
             if isinstance(v, Timestamp):
                 v = str(v)
-            gr.attrs[f'release_{k}'] = v
+            attrs[f'release_{k}'] = v
+
+        # Write the release:
+        obsid = release.release_attributes['name']
+        if self.layout == 'indexed':
+            self.add_indexed(obsid, release.footprint, attrs)
+        else :
+            self.add_grouped(obsid, release.footprint, attrs)
 
         logger.info(f"Added release {obsid} to file {self.filename}")
 
         # Add background, if needed
         if background is not None :
-            gr.create_group('background')
+            if self.layout == 'indexed':
+                if f'background/{obsid}' in self:
+                    del self[f'background/{obsid}']
+                bg = self.require_group('background').create_group(obsid)
+            else :
+                bg = self[obsid].create_group('background')
             for k, v in background.variables.items():
-                gr['background'][k] = v[:]
+                bg[k] = v[:]
                 # Copy netcdf attributes:
                 for attr in background[k].ncattrs():
-                    gr['background'][k].attrs[attr] = getattr(background[k], attr)
+                    bg[k].attrs[attr] = getattr(background[k], attr)
 
             # Correct time origin: currently it refers to the *end* (most recent date) of the simulation,
             # as opposed to what happened with the footprint:
-            gr['background']['time'][:] = gr['background']['time'][:] + (Timestamp(release.run_attributes['iedate'] + release.run_attributes['ietime']) - self.origin).total_seconds()
-            gr['background']['time'].attrs['units'] = f'seconds since {self.origin}'
-            gr['background']['time'].attrs['calendar'] = 'proleptic_gregorian'
+            bg['time'][:] = bg['time'][:] + (Timestamp(release.run_attributes['iedate'] + release.run_attributes['ietime']) - self.origin).total_seconds()
+            bg['time'].attrs['units'] = f'seconds since {self.origin}'
+            bg['time'].attrs['calendar'] = 'proleptic_gregorian'
+
+    def add_grouped(self, obsid: str, footprint: SimpleNamespace, attrs: dict) -> None:
+        """
+        Store the footprint in its own group (legacy layout)
+        """
+        # If a release with the same name is present, delete it
+        if obsid in self:
+            del self[obsid]
+
+        gr = self.create_group(obsid)
+        gr['ilons'] = footprint.ilon.astype(int16)
+        gr['ilats'] = footprint.ilat.astype(int16)
+        gr['itims'] = footprint.itime.astype(int16)
+        gr['sensi'] = footprint.sensi
+        self.written[obsid] = len(footprint.sensi)
+        for k in ['units', 'runflex_version', 'runflex_commit', 'runflex_dirty']:
+            if k in attrs :
+                gr['sensi'].attrs[k] = attrs.pop(k)
+        for k, v in attrs.items():
+            gr.attrs[k] = v
+
+    def add_indexed(self, obsid: str, footprint: SimpleNamespace, attrs: dict) -> None:
+        """
+        Append the footprint at the end of the concatenated ilons/ilats/itims/sensi datasets, and register it in the index
+        """
+        # If a release with the same name is present, remove it from the index (its data is not reclaimed)
+        if obsid in self.index:
+            self['index/obsid'][self.index.pop(obsid)] = ''
+
+        offset = self.append('sensi', footprint.sensi)
+        self.append('ilons', footprint.ilon.astype(int16))
+        self.append('ilats', footprint.ilat.astype(int16))
+        self.append('itims', footprint.itime.astype(int16))
+
+        self.index[obsid] = self.append('index/obsid', array([obsid], dtype=string_dtype()), chunk=1024)
+        self.append('index/offset', array([offset], dtype=int64), chunk=1024)
+        self.append('index/length', array([len(footprint.sensi)], dtype=int64), chunk=1024)
+        self.append('index/attributes', array([encode_attributes(attrs)], dtype=string_dtype()), chunk=1024)
+        self.written[obsid] = len(footprint.sensi)
+
+    def merge(self, filename: Union[str, Path]) -> int:
+        """
+        Copy all the footprints (and backgrounds) of another LUMIA file in "indexed" layout (e.g. a shard written by a
+        single task) into this one. In "indexed" layout, the datasets are copied in bulk.
+        Returns the number of footprints copied.
+        """
+        with File(filename, 'r') as shard :
+            if 'index' not in shard :
+                return 0
+            assert shard.attrs.get('layout') == 'indexed', f"Only files in indexed layout can be merged ({filename})"
+            assert Timestamp(shard.attrs['origin']) == self.origin
+
+            # Store/check lat and lon:
+            if 'latitudes' in self:
+                assert array_equal(self['latitudes'][:], shard['latitudes'][:])
+                assert array_equal(self['longitudes'][:], shard['longitudes'][:])
+            else :
+                shard.copy('latitudes', self)
+                shard.copy('longitudes', self)
+
+            # Global attributes. Run attributes that differ from the ones of this file are stored in the attributes of
+            # the footprints, as in "add":
+            diff = {}
+            for k, v in shard.attrs.items():
+                if k in ['origin', 'layout']:
+                    continue
+                if k not in self.attrs:
+                    self.attrs[k] = v
+                elif k.startswith('run_') and not array_equal(v, self.attrs[k]):
+                    diff[f'release_{k}'] = v
+
+            obsids = shard['index/obsid'].asstr()[:]
+            sel = obsids != ''
+            obsids = obsids[sel]
+            offsets = shard['index/offset'][:][sel]
+            lengths = shard['index/length'][:][sel]
+            attributes = [{**diff, **json.loads(attrs)} for attrs in shard['index/attributes'][:][sel]]
+
+            if self.layout == 'indexed':
+                for obsid in obsids :
+                    if obsid in self.index :
+                        self['index/obsid'][self.index.pop(obsid)] = ''
+                offset = self.append('sensi', shard['sensi'][:])
+                self.append('ilons', shard['ilons'][:])
+                self.append('ilats', shard['ilats'][:])
+                self.append('itims', shard['itims'][:])
+                irow = self.append('index/obsid', array(obsids.tolist(), dtype=string_dtype()), chunk=1024)
+                self.append('index/offset', offsets + offset, chunk=1024)
+                self.append('index/length', lengths, chunk=1024)
+                self.append('index/attributes', array([encode_attributes(attrs) for attrs in attributes], dtype=string_dtype()), chunk=1024)
+                self.index.update({obsid: irow + ii for (ii, obsid) in enumerate(obsids)})
+                self.written.update(zip(obsids, lengths))
+            else :
+                for obsid, offset, length, attrs in zip(obsids, offsets, lengths, attributes):
+                    fp = slice(offset, offset + length)
+                    self.add_grouped(obsid, SimpleNamespace(
+                        sensi=shard['sensi'][fp], ilon=shard['ilons'][fp], ilat=shard['ilats'][fp], itime=shard['itims'][fp]
+                    ), attrs)
+
+            # Backgrounds:
+            for obsid in shard.get('background', {}):
+                if self.layout == 'indexed':
+                    if f'background/{obsid}' in self:
+                        del self[f'background/{obsid}']
+                    shard.copy(shard['background'][obsid], self.require_group('background'), name=obsid)
+                else :
+                    shard.copy(shard['background'][obsid], self[obsid], name='background')
+
+        logger.info(f"Merged {len(obsids)} footprints from {filename} into {self.filename}")
+        return len(obsids)
+
+    def close(self) -> None:
+        super().close()
+        if self.inventory is not None and self.written :
+            self.inventory.add(self.path, self.written, current=self.current)
+            self.written = {}
+
+    def append(self, name: str, values: NDArray, chunk: int = 65536) -> int:
+        """
+        Append values to a (resizable) 1D dataset, which is created if needed. Returns the position of the first added value.
+        """
+        if name not in self:
+            self.create_dataset(name, shape=(0,), maxshape=(None,), dtype=values.dtype, chunks=(chunk,))
+        ds = self[name]
+        offset = ds.shape[0]
+        ds.resize((offset + len(values),))
+        ds[offset:] = values
+        return offset
+
 
 class GridTimeFile:
     def __init__(self, *args, **kwargs):
@@ -177,13 +370,10 @@ class GridTimeFile:
         nt = len(self.coordinates.time)
         nlat = len(self.coordinates.lat)
         nlon = len(self.coordinates.lon)
-        grid = meshgrid(range(nt), range(nlat), range(nlon), indexing='ij')
         height = self['height'][:].data
         assert len(height == 1), logger.critical("This script is only adapted for single-layer footprints")
         self.grid = SimpleNamespace(
-            time=grid[0].reshape(-1),
-            lat=grid[1].reshape(-1),
-            lon=grid[2].reshape(-1),
+            shape=(nt, nlat, nlon),
             height=height
         )
 
@@ -196,8 +386,40 @@ class GridTimeFile:
 
     def get(self, release_name: str) -> Release:
         irl = list(self.releases.name).index(release_name)
+        return self.release(irl, data=self['spec001_mr'][0, irl, :, 0, :, :][::-1, :, :].data)
+
+    def iter_releases(self, names: List[str] = None, chunksize: int = 8) -> Iterator[Release]:
+        """
+        Extract the footprints of all the requested releases (default: all the releases in the file), in the order of
+        the file. The data is read in blocks of "chunksize" consecutive releases, and each block is converted to sparse
+        format in a single pass, instead of reading and scanning the full grid once per release.
+        """
+        names = set(self.releases.name if names is None else names)
+        selected = [name in names for name in self.releases.name]
+
+        nrl = len(selected)
+        for irl0 in range(0, nrl, chunksize):
+            irl1 = min(irl0 + chunksize, nrl)
+            if not any(selected[irl0:irl1]):
+                continue
+
+            # Read a block of releases and find all its non-zero elements at once:
+            data = self['spec001_mr'][0, irl0:irl1, :, 0, :, :][:, ::-1, :, :].data.reshape(irl1 - irl0, -1)
+            irel, iflat = nonzero(data)
+            sensi = data[irel, iflat]
+            del data
+            bounds = searchsorted(irel, range(irl1 - irl0 + 1))
+
+            for ii, irl in enumerate(range(irl0, irl1)):
+                if not selected[irl]:
+                    continue
+                sel = slice(bounds[ii], bounds[ii + 1])
+                yield self.release(irl, sparse=sparse_footprint(sensi[sel], iflat[sel], self.grid.shape))
+
+    def release(self, irl: int, data: NDArray = None, sparse: SimpleNamespace = None) -> Release:
         return Release(
-            data=self['spec001_mr'][0, irl, :, 0, :, :][::-1, :, :].data,
+            data=data,
+            sparse=sparse,
             origin=self.start,
             dt=self.dt,
             grid=self.grid,
@@ -216,7 +438,17 @@ def postprocess_task(task) -> None:
 
     if task.status in ['success', 'skipped']:
 
-        releases.loc[:, 'filename'] = releases.code + releases.height.map('.{:.0f}m.'.format) + releases.time.dt.strftime('%Y-%m.hdf')
+        tstart = time.time()
+        # Each task writes to its own files (shards) if postprocess.shards is True. They are merged by "merge_shards".
+        # Otherwise, the footprints written are registered in the inventory of the output directory.
+        layout = task.rcf.postprocess.get('layout', 'grouped')
+        suffix = '.hdf'
+        inventory = Inventory(checkpath(task.rcf.paths.output))
+        if task.rcf.postprocess.get('shards', False):
+            layout = 'indexed'
+            suffix = f'.task{task.jobid}.hdf'
+            inventory = None
+        releases.loc[:, 'filename'] = releases.code + releases.height.map('.{:.0f}m.'.format) + releases.time.dt.strftime('%Y-%m') + suffix
 
         # Open the FLEXPART grid_time file:
         with GridTimeFile(task.end.strftime(os.path.join(task.rundir, 'grid_time_%Y%m%d%H%M%S.nc')), 'r') as gridfile:
@@ -228,16 +460,76 @@ def postprocess_task(task) -> None:
             else :
                 bg = SimpleNamespace(groups={})
 
-            # Iterate over the lumia footprint files (i.e. destination)
-            for file in releases.drop_duplicates(subset=['filename']).loc[:, ['filename', 'time']].itertuples():
-                origin = Timestamp(file.time.strftime('%Y-%m'))
-                with LumiaFile(os.path.join(checkpath(task.rcf.paths.output), file.filename), origin=origin, mode='a') as lum:
-                    for release in releases.loc[releases.filename == file.filename].obsid:
-                        lum.add(gridfile.get(release), bg.groups.get(release, None))
+            # Extract the footprints by blocks of releases. The footprints are grouped by destination lumia footprint
+            # file, and each file is written in one go, as soon as all its footprints have been extracted, so that it
+            # is opened only once per task, and not kept open (and locked) during the extraction:
+            destination = releases.set_index('obsid')
+            chunksize = task.rcf.postprocess.get('chunksize', 8)
+            remaining = destination.filename.value_counts().to_dict()
+            # (the initial size of the files is stored, to report the amount of data written)
+            sizes = {}
+
+            def write(filename: str, block: List[Release]) -> None:
+                origin = Timestamp(destination.loc[block[0].release_attributes['name'], 'time'].strftime('%Y-%m'))
+                path = os.path.join(checkpath(task.rcf.paths.output), filename)
+                sizes[path] = os.path.getsize(path) if os.path.exists(path) else 0
+                with LumiaFile(path, origin=origin, layout=layout, inventory=inventory, mode='a') as lf :
+                    for release in block :
+                        lf.add(release, bg.groups.get(release.release_attributes['name'], None))
+
+            pending = {}
+            for release in gridfile.iter_releases(destination.index, chunksize=chunksize):
+                filename = destination.loc[release.release_attributes['name'], 'filename']
+                pending.setdefault(filename, []).append(release)
+                remaining[filename] -= 1
+                if remaining[filename] == 0 :
+                    write(filename, pending.pop(filename))
+
+            # (releases missing from the FLEXPART output, if any)
+            for filename, block in pending.items():
+                write(filename, block)
 
             if bgfile.exists():
                 bg.close()
 
+        task.timings['postprocess'] = time.time() - tstart
+        task.timings['output_bytes'] = sum(os.path.getsize(path) - size for (path, size) in sizes.items())
+        update_journal(task, 'postprocessed')
+
+
+def postprocess_queue(queue: Queue) -> None:
+    """
+    Writer process: postprocess the tasks received through the queue, one at a time, until None is received.
+    Since only this process writes to the LUMIA files, the FLEXPART workers never wait for each other on the output files.
+    """
+    while (task := queue.get()) is not None :
+        try :
+            postprocess_task(task)
+        except Exception :
+            logger.exception(f"Postprocessing of task {task.jobid} failed")
+            update_journal(task, 'failed')
+        task.save_timings()
+
+
+def merge_shards(path: Union[str, Path], layout: str = 'grouped') -> None:
+    """
+    Merge the footprint files written by individual tasks (code.height.YYYY-MM.task{jobid}.hdf) into the monthly
+    footprint files (code.height.YYYY-MM.hdf). The shards are deleted once they have been merged.
+    """
+    shards = {}
+    for shard in sorted(Path(path).glob('*.task*.hdf')):
+        shards.setdefault(re.sub(r'\.task\d+\.hdf$', '.hdf', shard.name), []).append(shard)
+
+    for filename, files in shards.items():
+        with File(files[0], 'r') as shard :
+            origin = Timestamp(shard.attrs['origin'])
+        with LumiaFile(Path(path) / filename, origin=origin, layout=layout, inventory=Inventory(path), mode='a') as lum :
+            for shard in files :
+                lum.merge(shard)
+                os.remove(shard)
+
+    logger.info(f"Merged {sum(len(v) for v in shards.values())} shards into {len(shards)} footprint files")
+
 
 if __name__ == '__main__':
     pass
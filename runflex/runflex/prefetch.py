@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import threading
+from pathlib import Path
+from typing import List, Union
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from omegaconf import DictConfig
+from pandas import DataFrame, concat
+from numpy import maximum
+from runflex.meteo import Meteo, MeteoLeases, get_leases
+from runflex.tasks import JobInfo, Task, simulation_period
+
+
+class MeteoPrefetcher(threading.Thread):
+    """
+    Retrieve the meteo files of the tasks in the background, ahead of their execution, with several transfers in
+    parallel:
+    - the files are retrieved in the order in which the tasks need them (the tasks are assumed to start in the order
+      in which they are listed, "offset" of them at a time), by batches of at most "batchsize" files;
+    - the retrieval runs up to "window" files ahead of the files of the running tasks (by default, up to the files of
+      the next "offset" tasks);
+    - the files of each task are leased from the moment they start being retrieved, until the task completes;
+    - once all the files of a task have been retrieved (or attempted), a "meteo.ready" file is created in its run
+      directory. The tasks wait for it instead of retrieving their files themselves (see Task.setup_meteo), so that
+      each task only waits for its own files.
+    """
+    def __init__(self, jobs: List[JobInfo], meteo: Meteo, leases: MeteoLeases, window: int = None, offset: int = 1, transfers: int = 4, batchsize: int = 24):
+        super().__init__(daemon=True)
+        # (tasks for which FLEXPART has already completed are skipped, their meteo isn't needed)
+        jobs = [job for job in jobs if not (Path(job.rundir) / 'flexpart.ok').exists()]
+        self.jobs = jobs
+        self.jobids = {job.jobid for job in jobs}
+        self.meteo = meteo
+        self.leases = leases
+        self.window = window
+        self.offset = offset
+        self.transfers = transfers
+        self.batchsize = batchsize
+        self.completed = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.lock = threading.Lock()
+
+        # List of files needed by each task, and of all the files, in the order in which they are needed:
+        self.filelists = [meteo.gen_filelist(*simulation_period(job.releases, job.rcf)) for job in jobs]
+        self.files = concat(self.filelists).drop_duplicates('file').reset_index(drop=True)
+        position = DataFrame({'position': self.files.index}, index=self.files.file).position
+        self.first = [position[fl.file].min() for fl in self.filelists]
+        # Position of the last file needed by each task (or by any of the previous ones):
+        self.last = maximum.accumulate([position[fl.file].max() for fl in self.filelists])
+
+        self.retrieved = set()
+        self.nleased = 0
+        self.notready = set(range(len(jobs)))
+        for job in jobs :
+            self.readyfile(job).unlink(missing_ok=True)
+
+    @classmethod
+    def from_config(cls, rcf: DictConfig, jobs: List[JobInfo], offset: int = 1) -> Union["MeteoPrefetcher", None]:
+        """
+        Prefetcher for the meteo of the tasks, if it is retrieved from an archive (and meteo.prefetch is not False).
+        The look-ahead window (in number of files) and the number of parallel transfers are set by meteo.prefetch
+        and meteo.transfers. "offset" is the number of tasks running simultaneously: if it is not known (None), the
+        tasks can't wait for the prefetching, so there is no prefetcher.
+        """
+        window = rcf.meteo.get('prefetch', None)
+        if not jobs or not rcf.meteo.get('archive', None) or window is False :
+            return None
+        if offset is None :
+            logger.info("The number of simultaneous tasks is not bounded: the meteo is not prefetched")
+            return None
+        meteo = Meteo(
+            path=rcf.paths.meteo,
+            archive=rcf.meteo.archive,
+            prefix=rcf.meteo.prefix,
+            tres=rcf.meteo.interv,
+            logfile=rcf.meteo.get('logfile', sys.stdout)
+        )
+        return cls(jobs, meteo, get_leases(rcf), window=window, offset=offset, transfers=rcf.meteo.get('transfers', 4))
+
+    def holder(self, job: Union[JobInfo, Task]) -> str:
+        return f'prefetch {os.getpid()} {job.jobid}'
+
+    @staticmethod
+    def readyfile(job: Union[JobInfo, Task]) -> Path:
+        return Path(job.rundir) / Task.meteo_readyfile
+
+    @property
+    def limit(self) -> int:
+        """
+        Position of the last file that can be retrieved
+        """
+        running = min(self.completed + self.offset, len(self.jobs)) - 1
+        if self.window is None :
+            return self.last[min(running + self.offset, len(self.jobs) - 1)]
+        return self.last[running] + self.window
+
+    def run(self) -> None:
+        position = 0
+        with ThreadPoolExecutor(max_workers=self.transfers) as pool :
+            while position < len(self.files):
+                with self.condition :
+                    self.condition.wait_for(lambda: self.stopped or position <= self.limit)
+                    if self.stopped :
+                        pool.shutdown(cancel_futures=True)
+                        return
+                    end = min(self.limit + 1, position + self.batchsize)
+
+                # Lease the files of the tasks that need (some of) the files of the batch, before retrieving them
+                while self.nleased < len(self.jobs) and self.first[self.nleased] < end :
+                    self.leases.acquire(self.holder(self.jobs[self.nleased]), self.filelists[self.nleased].file)
+                    self.nleased += 1
+
+                pool.submit(self.retrieve, self.files.iloc[position: end])
+                position = end
+
+    def retrieve(self, files: DataFrame) -> None:
+        try :
+            self.meteo.fetch(files)
+        except Exception :
+            # The tasks will retry the retrieval themselves
+            logger.exception(f"Prefetching of the meteo files {files.file.iloc[0]} to {files.file.iloc[-1]} failed")
+
+        # Signal the tasks for which all the files have been processed (only the tasks already leased can be ready):
+        with self.lock :
+            self.retrieved.update(files.file)
+            for ijob in sorted(self.notready):
+                if ijob < self.nleased and self.retrieved.issuperset(self.filelists[ijob].file):
+                    self.readyfile(self.jobs[ijob]).parent.mkdir(parents=True, exist_ok=True)
+                    self.readyfile(self.jobs[ijob]).touch()
+                    self.notready.remove(ijob)
+
+    def done(self, job: Union[JobInfo, Task]) -> None:
+        """
+        Release the lease on the meteo of a completed task, and move the prefetching window forward.
+        """
+        if job.jobid not in self.jobids :
+            return
+        self.leases.release(self.holder(job))
+        with self.condition :
+            self.completed += 1
+            self.condition.notify()
+
+    def stop(self) -> None:
+        with self.condition :
+            self.stopped = True
+            self.condition.notify()
+        self.join()
+        self.leases.release(*[self.holder(job) for job in self.jobs])
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
-from pandas import DataFrame
+from pandas import DataFrame, to_datetime
 from typing import List
-from runflex.files import Release, ReleasesHeader
+from runflex.files import Release, ReleasesHeader, format_namelists
 
 
 class Releases(DataFrame):
@@ -21,6 +21,21 @@ class Releases(DataFrame):
             )
 
     def write(self, filename: str):
-        ReleasesHeader(len(self.species), self.species).write(filename, mode='w', name='RELEASES_CTRL')
-        for release in self.releases:
-            release.write(filename, mode='a', name='RELEASE')
+        """
+        Write the RELEASES file. The RELEASE namelists are formatted column by column (rather than through one Release
+        object per observation), and the whole file is written at once. The output is the same as writing each of the
+        "releases" with Release.write.
+        """
+        times = to_datetime(self.time)
+        dates, hours = times.dt.strftime('%Y%m%d').tolist(), times.dt.strftime('%H%M%S').tolist()
+        lat, lon, z = [list(map(str, self[col].astype(float).tolist())) for col in ['lat', 'lon', 'release_height']]
+        text = ReleasesHeader(len(self.species), self.species).format(name='RELEASES_CTRL') + format_namelists('RELEASE', {
+            'IDATE1': dates, 'ITIME1': hours, 'LAT1': lat, 'LON1': lon, 'Z1': z,
+            'ZKIND': list(map(str, self.kindz.astype(int).tolist())),
+            'MASS': list(map(str, self.mass.astype(float).tolist())),
+            'PARTS': list(map(str, self.npart.astype(int).tolist())),
+            'COMMENT': [f'"{obsid}"' for obsid in self.obsid.tolist()],
+            'IDATE2': dates, 'ITIME2': hours, 'LAT2': lat, 'LON2': lon, 'Z2': z
+        })
+        with open(filename, 'w') as fid:
+            fid.write(text)
@@ -6,12 +6,19 @@ from loguru import logger
 from argparse import ArgumentParser
 from netCDF4 import Dataset
 from pathlib import Path
+from multiprocessing import cpu_count
+from pandas import Timedelta
 
 # Pyflex
 from runflex.observations import Observations
 from runflex.manager import QueueManager
 from runflex.compile import Flexpart
 from runflex.config import OmegaConf, getfile
+from runflex.postprocess import merge_shards
+from runflex.git import get_provenance
+from runflex.costs import CostModel, MemoryModel
+from runflex.timings import TimingDatabase
+from runflex.journal import Journal, final_state
 
 # Types
 from omegaconf import DictConfig
@@ -22,6 +29,8 @@ class LumiaFootprintFile(Dataset):
 
     @property
     def footprints(self) -> List[str]:
+        if getattr(self, 'layout', 'grouped') == 'indexed':
+            return [obsid for obsid in self['index']['obsid'][:] if obsid]
         return list(self.groups.keys())
 
 
@@ -136,23 +145,110 @@ def calc_footprints(conf: DictConfig) -> Union[Observations, QueueManager]:
     if conf.run.cleanup:
         shutil.rmtree(conf.paths.run, ignore_errors=True)
 
-    # If it's a continuation (default True), check which footprints already exist:
+    # Merge the shards left by a previous (interrupted) run, if any:
+    shards = conf.postprocess.get('lumia', False) and conf.postprocess.get('shards', False)
+    if shards :
+        merge_shards(outpth, layout=conf.postprocess.get('layout', 'grouped'))
+
+    # If it's a continuation (default True), skip the observations of the tasks completed according to the journal
+    # (without checking the output files), and check which of the other footprints already exist:
+    if conf.run.recompute and conf.run.get('journal', None):
+        if 'obsid' not in obs :
+            obs.loc[:, 'obsid'] = obs.gen_obsid()
+        obs = obs.loc[~obs.obsid.isin(Journal(conf.run.journal).obsids([final_state(conf)]).obsid)]
+        if obs.empty :
+            logger.info(f"All the tasks in {conf.run.journal} have been completed")
+            return obs
     if conf.run.recompute:
         missing = handle_missing(obs, outpth)
         obs = obs.loc[missing]
         if not any(missing):
             return obs
 
+    # Determine the runflex version before starting the tasks, so it's done only once (the worker processes inherit it):
+    if conf.postprocess.get('lumia', False):
+        get_provenance()
+
     # Compute the footprints :
     queue = QueueManager(conf, obs, serial=conf.run.get('serial', False))
     queue.dispatch()
 
+    if shards :
+        merge_shards(outpth, layout=conf.postprocess.get('layout', 'grouped'))
+
     if conf.postprocess.get('lumia', False):
         handle_missing(obs, outpth)
 
     return queue
 
 
+def stats(conf: DictConfig, margin: float = 0.25) -> CostModel:
+    """
+    Summarize the timings of the past tasks (run.timings database), and fit the cost model used to split the
+    observations in tasks on them. If observations are defined in the configuration, the fitted model is used to
+    estimate the resources needed to compute their footprints (with "margin" added to the estimated time and memory),
+    which can be used to size the SLURM job (e.g. in submit_flexpart.sh).
+    """
+    if not conf.run.get('timings', None):
+        logger.warning("No timings database set (run.timings), the cost model can't be fitted")
+        return None
+    records = TimingDatabase(conf.run.timings).records
+    done = records.loc[records.status == 'success']
+    if done.empty :
+        logger.warning(f"No completed task found in {conf.run.timings}")
+        return None
+
+    logger.info(f"{len(done):.0f} completed tasks in {conf.run.timings} ({len(records) - len(done):.0f} failed or skipped tasks not used)")
+    print(done.loc[:, ['nobs', 'ndays', 'setup', 'meteo', 'flexpart', 'flexpart_cpu', 'flexpart_maxrss', 'postprocess', 'output_bytes']].describe().loc[['mean', 'min', 'max']].to_string())
+
+    model = CostModel.fit(records)
+    logger.info(f"Fitted cost model (run.cost_model setting): per_day : {model.per_day:.4g}, per_particle_day : {model.per_particle_day:.4g}")
+
+    if 'file' not in conf.observations and 'coordinates' not in conf.observations :
+        return model
+
+    # Estimate the resources needed for the footprints of the current configuration:
+    obs = load_obs(conf)
+    if conf.run.recompute :
+        obs = obs.loc[obs.check_footprints(conf.paths.output, LumiaFootprintFile)]
+    if obs.empty :
+        logger.info("All footprints have been computed")
+        return model
+
+    ncpus = conf.run.get('ncpus', cpu_count())
+    length = Timedelta(days=conf.releases.length)
+    tasks = Observations(obs).split(
+        nobsmax=conf.run.get('releases_per_task', 50), ncpus=ncpus, maxdt='7D',
+        packing=conf.run.get('packing', 'time'), cost=model, length=length, npart=conf.releases.npart
+    )
+    costs = [model.task_cost(rl.time, length, conf.releases.npart) for rl in tasks]
+
+    # The postprocessing is either done by the workers, after each task, or in parallel by the writer process
+    postprocess = done.postprocess.sum() / done.nobs.sum()
+    if conf.postprocess.get('lumia', False) and conf.postprocess.get('writer', False):
+        walltime = max(model.makespan(costs, ncpus), postprocess * len(obs))
+    elif conf.postprocess.get('lumia', False):
+        walltime = model.makespan([c + postprocess * len(rl) for (c, rl) in zip(costs, tasks)], ncpus)
+    else :
+        walltime = model.makespan(costs, ncpus)
+    walltime = int(walltime * (1 + margin))
+    # Memory: peak memory of the ncpus largest tasks, as predicted by the memory model (if it can be fitted), or
+    # otherwise based on the largest memory use recorded
+    if done.ncells.notna().any():
+        memmodel = MemoryModel.fit(records)
+        logger.info(f"Fitted memory model (run.memory_model setting): base : {memmodel.base:.4g}, per_particle : {memmodel.per_particle:.4g}, per_cell : {memmodel.per_cell:.4g}")
+        memory = sorted([memmodel.task_memory(len(rl), conf) for rl in tasks])[-ncpus:]
+        memory = sum(memory) / 1024 * (1 + margin)
+    else :
+        memory = done.flexpart_maxrss.max() * ncpus / 1024 * (1 + margin)
+
+    logger.info(f"Estimated resources for {len(obs):.0f} footprints in {len(tasks):.0f} tasks, on {ncpus:.0f} CPUs:")
+    logger.info(f"    #SBATCH -t {walltime // 3600:02d}:{walltime % 3600 // 60:02d}:{walltime % 60:02d}")
+    logger.info(f"    #SBATCH --mem={memory:.0f}M")
+
+    return model
+
+
 ###########################################################
 # Define parser:
 parser = ArgumentParser()
@@ -186,3 +282,5 @@ p_footprints.add_argument('--serial', '-i', action='store_true', default=False)
 p_footprints.add_argument('--ncpus', '-n', help='Number of parallell processes', default=None, type=int)
 p_footprints.add_argument('--cleanup', action='store_true', help="Ensure that the rundir is clear from previous runs (set to False by default as this will erase anything in the scratch dir, even if it doesn't belong to runflex!)")
 p_footprints.add_argument('--recompute', action='store_false', help='Use --recompute to force runflex to recompute any already existing footprints')
+p_footprints.add_argument('--stats', action='store_true', help='Fit the task cost model on the timings of past tasks (run.timings), and estimate the resources needed to compute the footprints')
+p_footprints.add_argument('--merge-shards', action='store_true', help='Merge the footprint files written by individual tasks (with postprocess.shards set to True) into the monthly footprint files')
@@ -2,25 +2,120 @@
 
 import subprocess
 import sys
+import time
+import socket
+import sqlite3
 from pandas import Timestamp, Timedelta
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 from runflex.utilities import checkpath
-from runflex.meteo import Meteo
+from runflex.meteo import Meteo, get_leases
 from runflex.releases import Releases
 from runflex.compile import Flexpart
 from runflex.postprocess import postprocess_task
+from runflex.timings import TimingDatabase
+from runflex.costs import outgrid_cells
+from runflex.journal import update_journal
 import os
+import json
 import shutil
+import hashlib
+import tempfile
 from loguru import logger
-from dataclasses import dataclass
-from typing import Union
+from dataclasses import dataclass, field
+from typing import Union, Tuple
 from pathlib import Path
 from runflex.files import Command, Outgrid, Species
-from runflex.utilities import getfile
-from multiprocessing import RLock
-
-
-meteo_lock = RLock()
+from runflex.utilities import getfile, link_tree
+
+
+def read_command(rcf: DictConfig) -> Command:
+    """
+    COMMAND file settings (COMMAND file given by paths.command, updated with the keys of the "command" section)
+    """
+    command = Command.read(rcf.paths.command)
+    if 'command' in rcf:
+        command.update(rcf.command)
+    return command
+
+
+def simulation_period(releases: Releases, rcf: DictConfig, command: Command = None) -> Tuple[Timestamp, Timestamp]:
+    """
+    Start and end of the FLEXPART simulation needed for a set of releases (aligned on the output time step)
+    """
+    command = read_command(rcf) if command is None else command
+    tmax = releases.time.max()
+    tmin = releases.time.min()
+    lenmax = rcf.releases.length
+    tmin = tmin - Timedelta(days=lenmax)
+
+    dt = Timedelta(seconds=command.LOUTAVER)
+    start, end = tmin, tmax
+    if dt <= Timedelta(days=1):
+        start = Timestamp(start.strftime('%Y%m%d'))
+        end = Timestamp(end.strftime('%Y%m%d'))
+        while start + dt < tmin:
+            start += dt
+        while end < tmax:
+            end += dt
+    else:
+        logger.error("LOUTAVER longer than 24 hours is not implemented in runflex (but it should be doable)")
+        raise NotImplementedError
+
+    return start, end
+
+
+datafiles = ['surfdata.t', 'surfdepo.t', 'IGBP_int1.dat']
+
+
+def write_species(rcf: DictConfig, dest: Path) -> None:
+    """
+    Write the SPECIES directory (either a standard FLEXPART species, or one defined in the releases.species section)
+    """
+    checkpath(os.path.join(dest, 'SPECIES'))
+    spec = rcf.releases.species
+    if isinstance(spec, int):
+        shutil.copy(getfile(f'SPECIES_{spec:03.0f}'), os.path.join(dest, 'SPECIES'))
+    elif isinstance(spec, DictConfig):
+        Species(**rcf.releases.species).write(Path(dest) / 'SPECIES' / f'SPECIES_999', name='SPECIES_PARAMS', prefix='P')
+
+
+def prepare_template(rcf: DictConfig) -> Union[Path, None]:
+    """
+    Prepare a template run directory, with the input files that are the same for all the tasks (land use and
+    deposition data, SPECIES and flexpart.x), from which the run directories of the tasks are populated (see
+    Task.setup). The template is created in the directory given by run.template ("template" in paths.run if it is
+    True), in a sub-directory named after its content, so that it is re-created if the FLEXPART executable or the
+    species change. Returns None if run.template is False (default: the files are then copied in each run directory).
+    """
+    setting = rcf.run.get('template', False)
+    if not setting :
+        return None
+    root = Path(rcf.paths.run) / 'template' if setting is True else Path(setting)
+
+    flexpart = Path(rcf.paths.build).absolute() / 'flexpart.x'
+    species = rcf.releases.species
+    content = {
+        'flexpart': [str(flexpart), flexpart.stat().st_size, flexpart.stat().st_mtime_ns],
+        'species': OmegaConf.to_container(species, resolve=True) if isinstance(species, DictConfig) else species,
+        'datafiles': [str(getfile(file)) for file in datafiles]
+    }
+    template = root / hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()[:16]
+    if template.exists():
+        return template
+
+    # Build the template in a temporary directory, and rename it once complete (if several processes do it at the
+    # same time, the first one to complete wins):
+    tmpdir = Path(tempfile.mkdtemp(dir=checkpath(root), prefix='.tmp.'))
+    for file in datafiles :
+        shutil.copy(getfile(file), tmpdir)
+    write_species(rcf, tmpdir)
+    shutil.copy(flexpart, tmpdir)
+    try :
+        tmpdir.rename(template)
+        logger.info(f"Template run directory created in {template}")
+    except OSError :
+        shutil.rmtree(tmpdir)
+    return template
 
 
 @dataclass(kw_only=True)
@@ -30,6 +125,10 @@ class JobInfo:
     releases: Releases
     jobid: int
     status: str = None
+    postprocess: bool = True
+    key: str = None
+    prefetched: bool = False
+    template: Path = None
 
     @property
     def dict(self) -> dict:
@@ -46,6 +145,13 @@ class Task:
     end: Timestamp = None
     interactive: bool = False
     status: str = None
+    postprocess: bool = True    # Set to False if the postprocessing is done by a separate writer process
+    key: str = None             # Content hash of the task (see runflex.journal.task_key)
+    prefetched: bool = False    # Set to True if the meteo files are retrieved in advance (see runflex.prefetch)
+    template: Path = None       # Template run directory (see prepare_template)
+
+    meteo_readyfile = 'meteo.ready'
+    timings: dict = field(default_factory=dict)
 
     def __post_init__(self):
 
@@ -69,30 +175,8 @@ class Task:
 
     @property
     def command(self) -> Command:
-        tmax = self.releases.time.max()
-        tmin = self.releases.time.min()
-        lenmax = self.rcf.releases.length
-        tmin = tmin - Timedelta(days=lenmax)
-
-        command = Command.read(self.rcf.paths.command)
-        if 'command' in self.rcf:
-            command.update(self.rcf.command)
-
-        dt = Timedelta(seconds=command.LOUTAVER)
-        start, end = tmin, tmax
-        if dt <= Timedelta(days=1):
-            start = Timestamp(start.strftime('%Y%m%d'))
-            end = Timestamp(end.strftime('%Y%m%d'))
-            while start + dt < tmin:
-                start += dt
-            while end < tmax:
-                end += dt
-        else:
-            logger.error("LOUTAVER longer than 24 hours is not implemented in runflex (but it should be doable)")
-            raise NotImplementedError
-
-        self.start = start
-        self.end = end
+        command = read_command(self.rcf)
+        self.start, self.end = simulation_period(self.releases, self.rcf, command)
 
         command.IBDATE = self.start
         command.IBTIME = self.start
@@ -121,30 +205,50 @@ class Task:
         return Flexpart(build=self.rcf.paths.build)
 
     def setup_species(self) -> None:
-        checkpath(os.path.join(self.rundir, 'SPECIES'))
-        spec = self.rcf.releases.species
-        if isinstance(spec, int):
-            shutil.copy(getfile(f'SPECIES_{spec:03.0f}'), os.path.join(self.rundir, 'SPECIES'))
-        elif isinstance(spec, DictConfig):
-            Species(**self.rcf.releases.species).write(self.rundir / 'SPECIES' / f'SPECIES_999', name='SPECIES_PARAMS', prefix='P')
+        write_species(self.rcf, self.rundir)
 
     def setup_meteo(self) -> None:
-        with meteo_lock:
-            logfile = self.rcf.meteo.get('logfile', sys.stdout)
-            if self.interactive:
-                logfile = sys.stdout
-            meteo = Meteo(
-                path=self.rcf.paths.meteo,
-                archive=self.rcf.meteo.get('archive', None),
-                prefix=self.rcf.meteo.prefix,
-                tres=self.rcf.meteo.interv,
-                task_id=self.jobid,
-                logfile=logfile
-            )
-            meteo.check_unmigrate(self.start, self.end)
-            meteo.write_AVAILABLE(os.path.join(self.rundir, 'AVAILABLE'))
-            if self.rcf.meteo.get('cleanup', False):
-                meteo.cleanup(threshold=self.rcf.meteo.cleanup.threshold, nfilesmin=self.rcf.meteo.cleanup.nfilesmin)
+        logfile = self.rcf.meteo.get('logfile', sys.stdout)
+        if self.interactive:
+            logfile = sys.stdout
+        meteo = Meteo(
+            path=self.rcf.paths.meteo,
+            archive=self.rcf.meteo.get('archive', None),
+            prefix=self.rcf.meteo.prefix,
+            tres=self.rcf.meteo.interv,
+            task_id=self.jobid,
+            logfile=logfile
+        )
+
+        # Take a lease on the meteo files needed, so that they are not removed by the cleanup of other tasks (the
+        # lease is released at the end of the FLEXPART run):
+        leases = get_leases(self.rcf)
+        if leases is not None :
+            leases.acquire(str(self.rundir), meteo.gen_filelist(self.start, self.end).file)
+
+        # If the meteo is prefetched, wait for it (the files that are still missing, if any, are retrieved after):
+        if self.prefetched :
+            twait = time.time()
+            self.wait_meteo(timeout=self.rcf.meteo.get('prefetch_timeout', 3600))
+            self.timings['meteo_wait'] = time.time() - twait
+
+        meteo.check_unmigrate(self.start, self.end)
+        meteo.write_AVAILABLE(os.path.join(self.rundir, 'AVAILABLE'), self.start, self.end)
+        if self.rcf.meteo.get('cleanup', False):
+            meteo.cleanup(threshold=self.rcf.meteo.cleanup.threshold, nfilesmin=self.rcf.meteo.cleanup.nfilesmin, leased=leases.leased)
+
+    def wait_meteo(self, timeout: float) -> None:
+        tstart = time.time()
+        while not (self.rundir / self.meteo_readyfile).exists():
+            if time.time() - tstart > timeout :
+                logger.warning(f"Task {self.jobid}: meteo not prefetched after {timeout} s")
+                return
+            time.sleep(1)
+
+    def release_meteo(self) -> None:
+        leases = get_leases(self.rcf)
+        if leases is not None :
+            leases.release(str(self.rundir))
 
     def setup_pathnames(self) -> None:
         with open(os.path.join(self.rundir, 'pathnames'), 'w') as fid:
@@ -164,18 +268,16 @@ class Task:
         self.releases.write(os.path.join(self.rundir, 'RELEASES'))
 
     def copy_datafiles(self) -> None:
-        shutil.copy(getfile('surfdata.t'), self.rundir)
-        shutil.copy(getfile('surfdepo.t'), self.rundir)
-        shutil.copy(getfile('IGBP_int1.dat'), self.rundir)
+        for file in datafiles :
+            shutil.copy(getfile(file), self.rundir)
 
     def setup(self) -> None:
 
+        tstart = time.time()
+
         # COMMAND file
         self.command.write(os.path.join(self.rundir, 'COMMAND'), name='COMMAND')
 
-        # SPECIES
-        self.setup_species()
-
         # OUTGRID
         self.outgrid.write(os.path.join(self.rundir, 'OUTGRID'), name='OUTGRID')
 
@@ -183,59 +285,105 @@ class Task:
         self.setup_releases()
 
         # meteo (AVAILABLE)
+        tmeteo = time.time()
         self.setup_meteo()
+        self.timings['meteo'] = time.time() - tmeteo
 
         # pathnames
         self.setup_pathnames()
 
-        # land use and surfdepo
-        self.copy_datafiles()
+        # land use, surfdepo, SPECIES and flexpart.x: linked from the template run directory, if there is one
+        if self.template is not None :
+            link_tree(self.template, self.rundir, method=self.rcf.run.get('template_links', 'hardlink'))
+        else :
+            self.setup_species()
+            self.copy_datafiles()
+            self.flexpart.setup(Path(self.rundir) / 'flexpart.x')
 
-        # flexpart.x
-        self.flexpart.setup(Path(self.rundir) / 'flexpart.x')
+        self.timings['setup'] = time.time() - tstart - self.timings['meteo']
 
     def run(self, retry: bool = True) -> "Task":
 
-        # Do not run the task if a "flexpart.ok" file has been found in the output folder (avoid overwriting existing data).
+        # Do not run FLEXPART if a "flexpart.ok" file has been found in the output folder (avoid overwriting existing
+        # data). The footprints are still extracted, as they may not have been (e.g. if the run was interrupted).
         if self.completed:
-            logger.info(f'Found okfile at {self.okfile}, returning ...')
+            logger.info(f'Found okfile at {self.okfile}, skipping the FLEXPART run ...')
             self.status = 'skipped'
-            return self
-
-        # Setup the task
-        self.setup()
-
-        # Run FLEXPART
-        if not self.interactive:
-            log_id = logger.add(sys.stdout, colorize=True, enqueue=True)
-            with open(self.rcf.run.logfile, 'a') as fid:
-                self.status = self.runflexpart(fid)
-            match self.status:
-                case 'success':
-                    logger.success(f'Task {self.jobid} completed ({self.rcf.run.logfile})')
-                case 'failed':
-                    logger.error(f'Task {self.jobid} failed ({self.rcf.run.logfile})')
-                    if retry:
-                        # Make another attempt, sometimes it's enough ...
-                        self.run(retry=False)
-            logger.remove(log_id)
-        else:
-            self.status = self.runflexpart(sys.stdout)
-
-        if self.rcf.postprocess.get('lumia', False):
+            # (the simulation period is still needed to find the FLEXPART output)
+            self.start, self.end = simulation_period(self.releases, self.rcf)
+        else :
+            update_journal(self, 'running')
+
+            try :
+                # Setup the task
+                self.setup()
+
+                # Run FLEXPART
+                if not self.interactive:
+                    log_id = logger.add(sys.stdout, colorize=True, enqueue=True)
+                    with open(self.rcf.run.logfile, 'a') as fid:
+                        self.status = self.runflexpart(fid)
+                    match self.status:
+                        case 'success':
+                            logger.success(f'Task {self.jobid} completed ({self.rcf.run.logfile})')
+                        case 'failed':
+                            logger.error(f'Task {self.jobid} failed ({self.rcf.run.logfile})')
+                    logger.remove(log_id)
+                else:
+                    self.status = self.runflexpart(sys.stdout)
+            finally :
+                self.release_meteo()
+
+            if self.status == 'failed' and retry and not self.interactive:
+                # Make another attempt, sometimes it's enough ...
+                return self.run(retry=False)
+
+        update_journal(self, 'failed' if self.status == 'failed' else 'flexpart_done')
+
+        if self.postprocess and self.rcf.postprocess.get('lumia', False):
             postprocess_task(self)
 
+        # If the postprocessing is done by a writer process, the timings are recorded from there.
+        if self.postprocess or not self.rcf.postprocess.get('lumia', False):
+            self.save_timings()
+
         return self
 
     def runflexpart(self, stdout) -> str:
         origin = os.getcwd()
         os.chdir(self.rundir)
-        status = subprocess.run(['./flexpart.x'], stdout=stdout)
+        # Wait for the process with os.wait4, to get its resource usage (CPU time and peak memory):
+        tstart = time.time()
+        process = subprocess.Popen(['./flexpart.x'], stdout=stdout)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        self.timings['flexpart'] = time.time() - tstart
+        self.timings['flexpart_cpu'] = usage.ru_utime + usage.ru_stime
+        self.timings['flexpart_maxrss'] = usage.ru_maxrss
         os.chdir(origin)
-        if status.returncode == 0 and self.completed:
+        if process.returncode == 0 and self.completed:
             return 'success'
         return 'failed'
 
+    def save_timings(self) -> None:
+        """
+        Append the timings of the task to the timings database (run.timings), if there is one.
+        """
+        if not self.rcf.run.get('timings', None):
+            return
+        ndays = None
+        if self.start is not None :
+            ndays = (self.end - self.start) / Timedelta(days=1)
+        try :
+            TimingDatabase(self.rcf.run.timings).add(
+                host=socket.gethostname(), rundir=str(self.rundir), jobid=self.jobid, status=self.status,
+                nobs=len(self.releases), nparticles=len(self.releases) * self.rcf.releases.npart, ndays=ndays,
+                ncells=len(self.releases) * outgrid_cells(self.rcf),
+                **self.timings
+            )
+        except sqlite3.Error :
+            logger.exception(f"The timings of task {self.jobid} could not be recorded")
+
     @classmethod
     def run_from_JobInfo(cls, jobinfo: JobInfo, interactive: bool = False):
         return cls(**jobinfo.dict, interactive=interactive).run()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from typing import List, Union
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from loguru import logger
+from omegaconf import DictConfig
+from runflex.tasks import Task, JobInfo
+from runflex.timings import TimingDatabase
+from runflex.journal import Journal
+
+
+class Telemetry(threading.Thread):
+    """
+    Progress and throughput of a footprint campaign, reported while the tasks are running:
+    - the status is rewritten every "interval" seconds in a JSON file (statusfile);
+    - if a port is given, it is also served in the Prometheus text format, on http://localhost:port/metrics.
+    The number of tasks completed and failed is counted by the QueueManager (see Telemetry.task_done), and the number
+    of running tasks is read from the journal (run.journal), if there is one. The time split between the different
+    steps (setup, meteo and wait for the prefetched meteo, FLEXPART, postprocessing) and the amount of data written are
+    read from the timings database (run.timings), since it also includes the tasks postprocessed by the writer process,
+    or otherwise summed over the tasks completed.
+    """
+    phases = ['setup', 'meteo', 'meteo_wait', 'flexpart', 'postprocess']
+
+    def __init__(self, jobs: List[JobInfo], ncpus: int, statusfile: Union[str, Path] = None, port: int = None, interval: float = 30., timings: Union[str, Path] = None, journal: Union[str, Path] = None):
+        super().__init__(daemon=True)
+        self.ntasks = len(jobs)
+        self.nreleases = sum(len(job.releases) for job in jobs)
+        self.ncpus = ncpus
+        self.statusfile = None if statusfile is None else Path(statusfile)
+        self.port = port
+        self.interval = interval
+        self.timings = timings
+        self.journal = journal
+        self.started = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.releases_done = 0
+        self.totals = dict.fromkeys(self.phases + ['output_bytes'], 0.)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.server = None
+
+    @classmethod
+    def from_config(cls, rcf: DictConfig, jobs: List[JobInfo], ncpus: int) -> Union["Telemetry", None]:
+        """
+        Telemetry set up by the run.telemetry section (keys "file", "port" and "interval"), if there is one.
+        """
+        conf = rcf.run.get('telemetry', None)
+        if not conf or not jobs :
+            return None
+        return cls(
+            jobs, ncpus, statusfile=conf.get('file', None), port=conf.get('port', None), interval=conf.get('interval', 30.),
+            timings=rcf.run.get('timings', None), journal=rcf.run.get('journal', None)
+        )
+
+    def task_done(self, task: Union[Task, JobInfo]) -> None:
+        with self.lock :
+            self.completed += 1
+            if task.status == 'failed':
+                self.failed += 1
+            else :
+                self.releases_done += len(task.releases)
+            for key in self.totals :
+                self.totals[key] += getattr(task, 'timings', {}).get(key, None) or 0.
+
+    @property
+    def status(self) -> dict:
+        with self.lock :
+            completed, failed, releases, totals = self.completed, self.failed, self.releases_done, dict(self.totals)
+
+        # Time split and data written by all the tasks of this campaign, including the postprocessing in the writer:
+        if self.timings and Path(self.timings).exists():
+            records = TimingDatabase(self.timings).select(since=self.started)
+            totals = {key: float(records[key].sum()) for key in totals}
+
+        running = min(self.ncpus, self.ntasks - completed)
+        if self.journal and Path(self.journal).exists():
+            running = Journal(self.journal).count('running', since=self.started)
+
+        elapsed = time.time() - self.started
+        return {
+            'updated': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'pid': os.getpid(),
+            'elapsed': elapsed,
+            'tasks': {'total': self.ntasks, 'done': completed - failed, 'failed': failed, 'running': running, 'queued': max(0, self.ntasks - completed - running)},
+            'releases': {'total': self.nreleases, 'done': releases, 'per_hour': releases / elapsed * 3600},
+            'seconds': {phase: totals[phase] for phase in self.phases},
+            'output_bytes': totals['output_bytes'],
+        }
+
+    @property
+    def metrics(self) -> str:
+        """
+        Status in the Prometheus text exposition format
+        """
+        status = self.status
+        lines = [
+            '# HELP runflex_tasks Number of runflex tasks, by state', '# TYPE runflex_tasks gauge',
+            *[f'runflex_tasks{{state="{state}"}} {value}' for (state, value) in status['tasks'].items()],
+            '# HELP runflex_releases_done_total Number of releases (footprints) completed', '# TYPE runflex_releases_done_total counter',
+            f'runflex_releases_done_total {status["releases"]["done"]}',
+            '# HELP runflex_releases_per_hour Average throughput since the start of the campaign', '# TYPE runflex_releases_per_hour gauge',
+            f'runflex_releases_per_hour {status["releases"]["per_hour"]:.6g}',
+            '# HELP runflex_task_seconds_total Time spent by the tasks, by step', '# TYPE runflex_task_seconds_total counter',
+            *[f'runflex_task_seconds_total{{step="{step}"}} {value:.6g}' for (step, value) in status['seconds'].items()],
+            '# HELP runflex_output_bytes_total Amount of data written to the footprint files', '# TYPE runflex_output_bytes_total counter',
+            f'runflex_output_bytes_total {status["output_bytes"]:.0f}',
+            '# HELP runflex_elapsed_seconds Time since the start of the campaign', '# TYPE runflex_elapsed_seconds gauge',
+            f'runflex_elapsed_seconds {status["elapsed"]:.6g}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self) -> None:
+        """
+        Rewrite the status file (through a temporary file, so that readers never see an incomplete file)
+        """
+        if self.statusfile is None :
+            return
+        self.statusfile.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.statusfile.with_suffix('.tmp'), 'w') as fid :
+            json.dump(self.status, fid, indent=2)
+        os.replace(self.statusfile.with_suffix('.tmp'), self.statusfile)
+
+    def serve(self) -> None:
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ['', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = telemetry.metrics.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f"Telemetry served on http://127.0.0.1:{self.server.server_port}/metrics")
+
+    def run(self) -> None:
+        while True :
+            try :
+                self.write()
+            except Exception :
+                logger.exception("The telemetry status file could not be written")
+            if self.stopped.wait(self.interval):
+                return
+
+    def start(self) -> None:
+        if self.port is not None :
+            self.serve()
+        super().start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+        self.write()
+        if self.server is not None :
+            self.server.shutdown()
+            self.server.server_close()
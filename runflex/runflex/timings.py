@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import time
+from pathlib import Path
+from typing import Union
+from pandas import DataFrame, read_sql
+from runflex.utilities import connect
+
+
+class TimingDatabase:
+    """
+    Record of the timings of the runflex tasks, stored in a SQLite database (one row per task execution):
+    - "nobs", "nparticles" and "ndays": number of releases, total number of particles released and length (in days)
+      of the simulated period;
+    - "ncells": size of the output (number of releases x number of cells of the output grid);
+    - "setup" (excluding the meteo), "meteo", "flexpart" (wall time), "flexpart_cpu" (user + system time of the
+      FLEXPART process) and "postprocess" durations, in seconds ("meteo_wait" is the part of "meteo" spent waiting for
+      the prefetched meteo files);
+    - "flexpart_maxrss": peak memory use of the FLEXPART process (in kB);
+    - "output_bytes": growth of the LUMIA footprint files written by the postprocessing.
+    The database is shared by the successive runs (and by the tasks of a run), so that the cost model used to split
+    the observations in tasks (see runflex.costs.CostModel.fit and "runflex --stats") can be fitted on past runs.
+    """
+    columns = {
+        'recorded': 'REAL', 'host': 'TEXT', 'rundir': 'TEXT', 'jobid': 'INTEGER', 'status': 'TEXT',
+        'nobs': 'INTEGER', 'nparticles': 'INTEGER', 'ndays': 'REAL', 'ncells': 'INTEGER',
+        'setup': 'REAL', 'meteo': 'REAL', 'meteo_wait': 'REAL', 'flexpart': 'REAL', 'flexpart_cpu': 'REAL', 'flexpart_maxrss': 'INTEGER',
+        'postprocess': 'REAL', 'output_bytes': 'INTEGER'
+    }
+
+    def __init__(self, filename: Union[str, Path]):
+        self.filename = Path(filename)
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        with connect(self.filename) as db :
+            db.execute(f'CREATE TABLE IF NOT EXISTS tasks ({", ".join(f"{k} {v}" for (k, v) in self.columns.items())})')
+            # Add the columns missing in databases created by older versions:
+            existing = [row[1] for row in db.execute('PRAGMA table_info(tasks)')]
+            for column in self.columns :
+                if column not in existing :
+                    db.execute(f'ALTER TABLE tasks ADD COLUMN {column} {self.columns[column]}')
+
+    def add(self, **record) -> None:
+        record['recorded'] = time.time()
+        # (numpy scalars are converted to python types, which sqlite3 can store)
+        record = {k: getattr(v, 'item', lambda: v)() for (k, v) in record.items() if k in self.columns}
+        with connect(self.filename) as db :
+            db.execute(f'INSERT INTO tasks ({", ".join(record)}) VALUES ({", ".join("?" * len(record))})', list(record.values()))
+
+    @property
+    def records(self) -> DataFrame:
+        with connect(self.filename) as db :
+            return read_sql('SELECT * FROM tasks', db)
+
+    def select(self, since: float = 0.) -> DataFrame:
+        """
+        Records added since the "since" time (in seconds since the epoch)
+        """
+        with connect(self.filename) as db :
+            return read_sql('SELECT * FROM tasks WHERE recorded >= ?', db, params=(since,))
@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
 import os
+import shutil
+import sqlite3
 import subprocess
 from loguru import logger
-from typing import Union, List
+from typing import Union, List, Set
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from importlib import metadata
+from contextlib import contextmanager
+from functools import cache
 
 
+@cache
 def getfile(filename: str) -> Path:
     files = [_.locate() for _ in metadata.files('runflex') if str(_).endswith(filename)]
     assert len(files) == 1, logger.critical(f"Can't resolve the path to {filename} as several files share the name")
@@ -25,3 +31,66 @@ def checkpath(path: Union[Path, str]) -> Path:
     if not os.path.isdir(path):
         os.makedirs(path)
     return Path(path)
+
+
+@contextmanager
+def connect(filename: Union[Path, str]) -> sqlite3.Connection:
+    """
+    Connect to a SQLite database. The changes are committed (or rolled back in case of error) and the connection is
+    closed on exit. The large timeout allows several processes to share the database.
+    """
+    db = sqlite3.connect(filename, timeout=600)
+    try :
+        with db :
+            yield db
+    finally :
+        db.close()
+
+
+def list_files(path: Union[Path, str]) -> Set[str]:
+    """
+    Names of the files in a directory, from a single listing (rather than one metadata request per file, which is
+    slow on parallel file systems). Returns an empty set if the directory doesn't exist.
+    """
+    try :
+        with os.scandir(path) as entries :
+            return {entry.name for entry in entries}
+    except FileNotFoundError :
+        return set()
+
+
+def touch(files: List[Union[Path, str]], nthreads: int = 8, batchsize: int = 64) -> None:
+    """
+    Set the access and modification times of (existing) files to the current time. The files are processed by batches,
+    in a pool of threads, so that the metadata requests don't wait for each other.
+    """
+    def touch_batch(batch: List[Union[Path, str]]) -> None:
+        for file in batch :
+            os.utime(file)
+
+    batches = [files[i: i + batchsize] for i in range(0, len(files), batchsize)]
+    with ThreadPoolExecutor(max_workers=nthreads) as pool :
+        list(pool.map(touch_batch, batches))
+
+
+def link_tree(src: Union[Path, str], dest: Union[Path, str], method: str = 'hardlink') -> None:
+    """
+    Populate the "dest" directory with the files (and sub-directories) of "src", as hard links, symbolic links or
+    copies (method = "hardlink", "symlink" or "copy"). Links that can't be created (e.g. hard links across file
+    systems) are replaced by copies. Existing files in dest are overwritten.
+    """
+    assert method in ['hardlink', 'symlink', 'copy'], logger.critical(f"Unknown link method: {method}")
+    src, dest = Path(src).absolute(), Path(dest)
+    for path, dirs, files in os.walk(src):
+        target = checkpath(dest / Path(path).relative_to(src))
+        for file in files :
+            (target / file).unlink(missing_ok=True)
+            try :
+                if method == 'hardlink' :
+                    os.link(os.path.join(path, file), target / file)
+                elif method == 'symlink' :
+                    os.symlink(os.path.join(path, file), target / file)
+                else :
+                    shutil.copy(os.path.join(path, file), target / file)
+            except OSError :
+                shutil.copy(os.path.join(path, file), target / file)
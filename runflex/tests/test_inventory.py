@@ -0,0 +1,70 @@
+import os
+from pandas import DataFrame, Timestamp
+from runflex.inventory import Inventory
+from runflex.observations import Observations
+
+
+class FakeFootprintFile:
+    """
+    Stand-in for the footprint file class: the obsids are the lines of the file
+    """
+    opened = []
+
+    def __init__(self, filename: str, mode: str = 'r'):
+        self.filename = filename
+
+    def __enter__(self):
+        self.opened.append(os.path.basename(self.filename))
+        with open(self.filename) as fid :
+            self.footprints = fid.read().split()
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def test_refresh_modified_files(tmp_path):
+    """
+    Only the files modified (modification time or size) since they were last recorded are re-scanned.
+    """
+    file = tmp_path / 'xxx.100m.2018-01.hdf'
+    file.write_text('a b\n')
+    inventory = Inventory(tmp_path)
+    assert not inventory.is_current(file)
+
+    FakeFootprintFile.opened = []
+    inventory.refresh([file], FakeFootprintFile)
+    inventory.refresh([file], FakeFootprintFile)
+    assert FakeFootprintFile.opened == [file.name]
+    assert inventory.is_current(file)
+    assert sorted(inventory.footprints.obsid) == ['a', 'b']
+
+    # Same modification time, but a different size:
+    stat = os.stat(file)
+    file.write_text('a b c\n')
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert not inventory.is_current(file)
+    inventory.refresh([file], FakeFootprintFile)
+    assert sorted(inventory.footprints.obsid) == ['a', 'b', 'c']
+
+
+def test_add_keeps_inventory_current(tmp_path):
+    file = tmp_path / 'xxx.100m.2018-01.hdf'
+    file.write_text('')
+    inventory = Inventory(tmp_path)
+    inventory.add(file, {'a': 10})
+    assert inventory.is_current(file)
+    assert inventory.footprints.loc[:, ['filename', 'obsid', 'size']].values.tolist() == [[file.name, 'a', 10]]
+
+
+def test_check_footprints(tmp_path):
+    """
+    The footprints are searched in the inventory by file name and obsid.
+    """
+    obs = Observations(DataFrame({
+        'time': [Timestamp(2018, 1, 1, 12), Timestamp(2018, 1, 1, 13), Timestamp(2018, 2, 1, 12)],
+        'code': 'xxx', 'height': 100.
+    }))
+    (tmp_path / 'xxx.100m.2018-01.hdf').write_text('xxx.100m.20180101-120000\nxxx.100m.20180201-120000\n')
+    missing = obs.check_footprints(str(tmp_path), FakeFootprintFile)
+    assert missing == [False, True, True]
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+from pandas import DataFrame, date_range
+from omegaconf import OmegaConf
+from runflex.journal import Journal, task_key
+
+
+def make_obs(n: int = 6) -> DataFrame:
+    times = date_range('2018-01-01', periods=n, freq='3h')
+    return DataFrame({'time': times, 'obsid': [f'xxx.{t:%Y%m%d-%H%M%S}' for t in times], 'lat': 50., 'lon': 10.})
+
+
+def make_jobs(obs: DataFrame, rcf, size: int = 2) -> list:
+    jobs = []
+    for jobid, i0 in enumerate(range(0, len(obs), size)):
+        releases = obs.iloc[i0:i0 + size]
+        key = task_key(releases, rcf)
+        jobs.append(SimpleNamespace(key=key, jobid=jobid, rundir=f'/run/{key}', releases=releases))
+    return jobs
+
+
+def test_task_key():
+    """
+    The key depends on the content of the task (and on the FLEXPART settings), not on the order of its releases.
+    """
+    rcf = OmegaConf.create({'releases': {'npart': 100}, 'paths': {}})
+    obs = make_obs(4)
+    assert task_key(obs, rcf) == task_key(obs.iloc[::-1], rcf)
+    assert task_key(obs, rcf) != task_key(obs.iloc[1:], rcf)
+    assert task_key(obs, rcf) != task_key(obs, OmegaConf.create({'releases': {'npart': 200}, 'paths': {}}))
+
+
+def test_resume(tmp_path):
+    """
+    The completed tasks are skipped, and the unfinished ones are re-created identically.
+    """
+    rcf = OmegaConf.create({'releases': {'npart': 100}, 'paths': {}})
+    obs = make_obs(6)
+    journal = Journal(tmp_path / 'journal.db')
+    jobs = make_jobs(obs, rcf)
+    journal.queue(jobs)
+    assert journal.count('queued') == 3
+
+    journal.update(jobs[0].key, 'postprocessed')
+    journal.update(jobs[1].key, 'flexpart_done')
+    assert sorted(journal.obsids(['postprocessed']).obsid) == sorted(jobs[0].releases.obsid)
+
+    # Observations of the completed task are left out (by the caller), those of the unfinished tasks are regrouped:
+    remaining = obs.loc[~obs.obsid.isin(journal.obsids(['postprocessed']).obsid)]
+    tasks, rest = journal.resume(remaining, rcf)
+    assert sorted(task_key(rl, rcf) for rl in tasks) == sorted([jobs[1].key, jobs[2].key])
+    assert rest.empty
+
+    # Re-queuing the tasks keeps the state of the tasks for which FLEXPART has completed:
+    journal.queue(jobs[1:])
+    assert journal.count('flexpart_done') == 1
+    assert journal.count('queued') == 1
+
+
+def test_resume_changed_task(tmp_path):
+    """
+    A task is not re-created if some of its observations are missing, or if the settings have changed.
+    """
+    rcf = OmegaConf.create({'releases': {'npart': 100}, 'paths': {}})
+    obs = make_obs(4)
+    journal = Journal(tmp_path / 'journal.db')
+    journal.queue(make_jobs(obs, rcf))
+
+    tasks, rest = journal.resume(obs.iloc[1:], rcf)
+    assert [task_key(rl, rcf) for rl in tasks] == [task_key(obs.iloc[2:], rcf)]
+    assert rest.obsid.tolist() == obs.obsid.iloc[1:2].tolist()
+
+    tasks, rest = journal.resume(obs, OmegaConf.create({'releases': {'npart': 200}, 'paths': {}}))
+    assert tasks == []
+    assert len(rest) == len(obs)
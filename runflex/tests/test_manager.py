@@ -0,0 +1,30 @@
+from pathlib import Path
+from pandas import DataFrame, date_range
+from omegaconf import OmegaConf
+from runflex.manager import QueueManager
+from runflex.utilities import getfile
+
+
+def test_no_template_for_completed_tasks(tmp_path):
+    """
+    The template run directory (which requires the FLEXPART executable) is not prepared if FLEXPART has already
+    completed for all the tasks.
+    """
+    rcf = OmegaConf.create({
+        'paths': {'run': str(tmp_path), 'command': str(getfile('COMMAND')), 'output': str(tmp_path / 'output'), 'build': str(tmp_path / 'build')},
+        'run': {'logfile': str(tmp_path / 'flexpart.out'), 'ncpus': 2, 'releases_per_task': 2},
+        'releases': {'length': 14, 'npart': 100, 'species': 22},
+        'postprocess': {'lumia': True},
+    })
+    obs = DataFrame({'time': date_range('2018-01-01', periods=4, freq='6h'), 'code': 'xxx', 'height': 100., 'lat': 50., 'lon': 10., 'alt': 0.})
+
+    tasks = QueueManager(rcf, obs.copy()).create_tasks()
+    assert len(tasks) == 2
+    for task in tasks :
+        Path(task.rundir).mkdir(parents=True)
+        (Path(task.rundir) / 'flexpart.ok').touch()
+
+    # (there is no flexpart.x in paths.build, so preparing the template would fail)
+    rcf.run.template = True
+    tasks = QueueManager(rcf, obs.copy()).create_tasks()
+    assert [task.template for task in tasks] == [None, None]
@@ -0,0 +1,18 @@
+import os
+import time
+from runflex.meteo import Meteo
+
+
+def test_cleanup_keeps_most_recent_files(tmp_path):
+    """
+    The nfilesmin most recently used meteo files are kept, as well as the leased ones.
+    """
+    now = time.time()
+    for ifile in range(5):
+        file = tmp_path / f'EA1801010{ifile}'
+        file.touch()
+        os.utime(file, (now - 3600 * (5 - ifile), now - 3600 * (5 - ifile)))
+
+    Meteo(path=tmp_path, archive=None, tres='1h').cleanup(nfilesmin=2, leased={'EA18010100'})
+
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['EA18010100', 'EA18010103', 'EA18010104']
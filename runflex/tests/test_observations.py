@@ -0,0 +1,81 @@
+from pandas import DataFrame, Timestamp, Timedelta, concat
+from runflex.observations import Observations, merge_tasks
+from runflex.releases import Releases
+
+
+def make_tasks(ntasks: int, size: int = 5, step: Timedelta = Timedelta(hours=6)) -> list:
+    """
+    Tasks of "size" hourly releases, starting every "step"
+    """
+    start = Timestamp(2018, 1, 1)
+    return [Releases(DataFrame({
+        'time': [start + itask * step + Timedelta(hours=irl) for irl in range(size)],
+        'obsid': [f'{itask}.{irl}' for irl in range(size)]
+    })) for itask in range(ntasks)]
+
+
+def obsids(tasks: list) -> list:
+    return sorted(concat(tasks).obsid)
+
+
+def test_merge_overlapping_tasks():
+    tasks = make_tasks(8)
+    merged = merge_tasks(tasks, maxreleases=20)
+    assert [len(rl) for rl in merged] == [20, 20]
+    assert obsids(merged) == obsids(tasks)
+    assert all(rl.time.is_monotonic_increasing for rl in merged)
+
+
+def test_merge_default_limit():
+    """
+    Without limits, the merged tasks have at most four times the releases of the largest task
+    """
+    merged = merge_tasks(make_tasks(40))
+    assert len(merged) == 10
+    assert max(len(rl) for rl in merged) == 20
+
+
+def test_merge_mintasks():
+    """
+    The tasks are not merged below "mintasks" tasks
+    """
+    merged = merge_tasks(make_tasks(40), maxreleases=1000, mintasks=16)
+    assert len(merged) == 16
+    assert obsids(merged) == obsids(make_tasks(40))
+
+
+def test_no_merge_without_overlap():
+    """
+    Tasks whose simulated periods overlap less than "overlap" are not merged
+    """
+    tasks = make_tasks(3, step=Timedelta(days=10))
+    merged = merge_tasks(tasks, overlap=0.75, maxreleases=1000)
+    assert [rl.obsid.tolist() for rl in merged] == [rl.obsid.tolist() for rl in tasks]
+
+
+def test_merge_maxparticles():
+    merged = merge_tasks(make_tasks(8), maxparticles=1000, npart=100)
+    assert [len(rl) for rl in merged] == [10, 10, 10, 10]
+
+
+def make_obs(times: list) -> Observations:
+    return Observations(DataFrame({'time': times, 'code': 'xxx', 'height': 100., 'obsid': [f'{t:%Y%m%d%H}' for t in times]}))
+
+
+def test_pack_limits():
+    """
+    The packed tasks contain all the observations, with at most nobsmax observations at most maxdt apart
+    """
+    times = [Timestamp(2018, 1, 1) + Timedelta(hours=3 * i) for i in range(40)] + [Timestamp(2018, 3, 1) + Timedelta(hours=i) for i in range(10)]
+    tasks = make_obs(times).pack(nobsmax=12, ncpus=2, maxdt='2D', length=Timedelta(days=14))
+    assert sorted(concat(tasks).obsid) == sorted(make_obs(times).obsid)
+    assert all(len(rl) <= 12 and rl.time.max() - rl.time.min() <= Timedelta('2D') for rl in tasks)
+
+
+def test_pack_separates_distant_observations():
+    """
+    Observations far apart in time are not packed together (their simulated periods don't overlap)
+    """
+    times = [Timestamp(2018, 1, 1) + Timedelta(hours=i) for i in range(5)] + [Timestamp(2018, 6, 1) + Timedelta(hours=i) for i in range(5)]
+    tasks = make_obs(times).pack(nobsmax=20, ncpus=1, maxdt='365D', length=Timedelta(days=14))
+    assert sorted(len(rl) for rl in tasks) == [5, 5]
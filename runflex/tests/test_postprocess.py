@@ -0,0 +1,97 @@
+import json
+from types import SimpleNamespace
+import pytest
+from h5py import File
+from numpy import array, arange, int16, linspace
+from pandas import Timestamp, Timedelta
+import runflex.postprocess
+from runflex.git import Provenance
+from runflex.inventory import Inventory
+from runflex.postprocess import LumiaFile, Release, merge_shards
+
+
+@pytest.fixture(autouse=True)
+def provenance(monkeypatch):
+    monkeypatch.setattr(runflex.postprocess, 'get_provenance', lambda: Provenance('2024.1.1', 'abc'))
+
+
+def make_release(obsid: str, sensi: list) -> Release:
+    n = len(sensi)
+    return Release(
+        data=None, origin=Timestamp(2018, 1, 2), dt=Timedelta(hours=1),
+        release_attributes={'name': obsid}, run_attributes={'ibdate': '20180101'},
+        coordinates=SimpleNamespace(lon=linspace(0, 9, 10), lat=linspace(40, 49, 10), time=Timestamp(2018, 1, 2)),
+        specie={'units': 's.m2/mol'},
+        sparse=SimpleNamespace(sensi=array(sensi, dtype=float), ilat=arange(n).astype(int16), ilon=arange(n).astype(int16), itime=arange(n).astype(int16)),
+    )
+
+
+def read_footprints(filename) -> dict:
+    """
+    Footprints of a LUMIA file (obsid: (sensi, itims)), in either layout
+    """
+    with File(filename, 'r') as fid :
+        if fid.attrs.get('layout') == 'indexed':
+            obsids = fid['index/obsid'].asstr()[:]
+            return {
+                obsid: (fid['sensi'][o:o + n].tolist(), fid['itims'][o:o + n].tolist())
+                for (obsid, o, n) in zip(obsids, fid['index/offset'][:], fid['index/length'][:]) if obsid
+            }
+        return {obsid: (fid[obsid]['sensi'][:].tolist(), fid[obsid]['itims'][:].tolist()) for obsid in fid if obsid not in ['latitudes', 'longitudes']}
+
+
+@pytest.mark.parametrize('layout', ['indexed', 'grouped'])
+def test_append_and_replace(tmp_path, layout):
+    """
+    Footprints are appended to existing files (in their own layout), and a footprint written again replaces the
+    previous one.
+    """
+    filename = tmp_path / 'xxx.100m.2018-01.hdf'
+    origin = Timestamp(2018, 1, 1)
+    with LumiaFile(filename, origin=origin, layout=layout, mode='a') as lf :
+        lf.add(make_release('a', [1., 2.]), None)
+        lf.add(make_release('b', [3.]), None)
+
+    # (the layout of the existing file is kept)
+    with LumiaFile(filename, origin=origin, layout='grouped' if layout == 'indexed' else 'indexed', mode='a') as lf :
+        assert lf.layout == layout
+        lf.add(make_release('a', [4., 5., 6.]), None)
+
+    # The time indices are relative to the origin of the file (one day, i.e. 24 time steps, before the release):
+    assert read_footprints(filename) == {'a': ([4., 5., 6.], [24, 25, 26]), 'b': ([3.], [24])}
+    if layout == 'indexed':
+        with File(filename, 'r') as fid :
+            attributes = [json.loads(attrs) for attrs in fid['index/attributes'].asstr()[:]]
+        assert attributes[-1]['release_name'] == 'a'
+        assert attributes[-1]['runflex_version'] == '2024.1.1'
+
+
+def test_inventory_registration(tmp_path):
+    filename = tmp_path / 'xxx.100m.2018-01.hdf'
+    inventory = Inventory(tmp_path)
+    with LumiaFile(filename, origin=Timestamp(2018, 1, 1), layout='indexed', inventory=inventory, mode='a') as lf :
+        lf.add(make_release('a', [1., 2.]), None)
+    assert inventory.is_current(filename)
+    assert inventory.footprints.loc[:, ['obsid', 'size']].values.tolist() == [['a', 2]]
+
+
+@pytest.mark.parametrize('layout', ['indexed', 'grouped'])
+def test_merge_shards(tmp_path, layout):
+    """
+    The shards written by the tasks are merged into the monthly files (the most recent footprints replacing the older
+    ones), and then deleted.
+    """
+    origin = Timestamp(2018, 1, 1)
+    with LumiaFile(tmp_path / 'xxx.100m.2018-01.hdf', origin=origin, layout=layout, mode='a') as lf :
+        lf.add(make_release('a', [1.]), None)
+    with LumiaFile(tmp_path / 'xxx.100m.2018-01.task0.hdf', origin=origin, layout='indexed', mode='a') as lf :
+        lf.add(make_release('a', [2., 3.]), None)
+        lf.add(make_release('b', [4.]), None)
+    with LumiaFile(tmp_path / 'xxx.100m.2018-01.task1.hdf', origin=origin, layout='indexed', mode='a') as lf :
+        lf.add(make_release('c', [5.]), None)
+
+    merge_shards(tmp_path, layout=layout)
+
+    assert sorted(f.name for f in tmp_path.glob('*.hdf')) == ['xxx.100m.2018-01.hdf']
+    assert read_footprints(tmp_path / 'xxx.100m.2018-01.hdf') == {'a': ([2., 3.], [24, 25]), 'b': ([4.], [24]), 'c': ([5.], [24])}
+    assert sorted(Inventory(tmp_path).footprints.obsid) == ['a', 'b', 'c']
@@ -0,0 +1,31 @@
+from pandas import DataFrame, Timestamp
+from omegaconf import OmegaConf
+import runflex.tasks
+from runflex.tasks import Task, simulation_period
+from runflex.releases import Releases
+from runflex.utilities import getfile
+
+
+def test_resume_task_with_okfile(tmp_path, monkeypatch):
+    """
+    A task whose FLEXPART run has already completed (flexpart.ok in its run directory) is only postprocessed, and
+    the postprocessing needs its simulation period.
+    """
+    rcf = OmegaConf.create({
+        'paths': {'run': str(tmp_path), 'command': str(getfile('COMMAND')), 'output': str(tmp_path / 'output')},
+        'run': {'logfile': str(tmp_path / 'flexpart.out')},
+        'releases': {'length': 14, 'npart': 100},
+        'postprocess': {'lumia': True},
+    })
+    releases = Releases(DataFrame({'time': [Timestamp(2018, 1, 5, 12), Timestamp(2018, 1, 6, 15)], 'obsid': ['a', 'b']}))
+    rundir = tmp_path / 'task'
+    rundir.mkdir()
+    (rundir / 'flexpart.ok').touch()
+
+    postprocessed = []
+    monkeypatch.setattr(runflex.tasks, 'postprocess_task', lambda task: postprocessed.append((task.start, task.end)))
+
+    task = Task(releases, rcf, rundir, jobid=0, interactive=True).run()
+
+    assert task.status == 'skipped'
+    assert postprocessed == [simulation_period(releases, rcf)]
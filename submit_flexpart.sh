@@ -6,6 +6,10 @@
 #SBATCH --mail-type=FAIL,END
 #SBATCH --mem=60000M
 
+# Time and memory estimates, based on the timings of previous runs, can be obtained with "runflex --stats --rc flexpart_co2.yaml --ncpus 32"
+# With "--setkey run.memory:auto", runflex only starts as many tasks as fit in the memory allocated to the job
+# To spread the tasks over several nodes, set "run.executor" to "slurm" (in that case, this job only submits and monitors the tasks, and can be given a single core)
+
 singularity run --cleanenv --bind /projects:/projects --bind /projects/0/ctdas/awoude/Tvarita/FLEXPART/footprints:/output --bind /gpfs/scratch1/shared/rdkok/4Tvarita/FLEXPART_runs:/scratch --bind /projects/0/ctdas/awoude/Tvarita/FLEXPART:/TvaritaDirectory -H /home/dkivits/FLEXPART:/home runflex.sif --footprints --rc flexpart_co2.yaml --ncpus 32 --start 20180101 --end 20180201
 #singularity run --cleanenv --bind /projects:/projects --bind /projects/0/ctdas/awoude/Tvarita/FLEXPART/footprints:/output --bind /gpfs/scratch1/shared/rdkok/4Tvarita/FLEXPART_runs:/scratch --bind /projects/0/ctdas/awoude/Tvarita/FLEXPART:/TvaritaDirectory -H $PWD:/home runflex.sif --footprints --rc flexpart_co2.yaml --ncpus 32 --start 20180101 --end 20180201
 #singularity run --cleanenv --bind /projects:/projects --bind /projects/0/ctdas/dkivits/DATA/FLEXPART/code/footprints:/output --bind /gpfs/scratch1/shared/rdkok/4Daan/FLEXPART_runs:/scratch -H $PWD:/home runflex.sif --footprints --rc flexpart_co2.yaml --ncpus 32 --start 20180101 --end 20190101